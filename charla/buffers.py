@@ -0,0 +1,90 @@
+"""Buffers Module
+
+Bounded per-connection receive buffers used by the server's line
+protocol in place of immutable bytes concatenation.
+"""
+
+
+class Buffer(bytearray):
+    """Receive buffer holding a connection's partial line"""
+
+    # Set while the rest of an overlong line is being discarded
+    truncated = False
+
+
+class Buffers(object):
+    """Receive buffer manager
+
+    Lines longer than ``linelen`` bytes (including the trailing CRLF)
+    are truncated and the remainder discarded up to the next line break,
+    so a client can never make its buffer grow without bound.
+    """
+
+    def __init__(self, linelen=512):
+        self.linelen = linelen
+        self.buffers = {}
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def __contains__(self, sock):
+        return sock in self.buffers
+
+    @property
+    def size(self):
+        """Total number of bytes buffered across all connections"""
+
+        return sum(len(buffer) for buffer in self.buffers.values())
+
+    def get(self, sock):
+        buffer = self.buffers.get(sock)
+        if buffer is None:
+            buffer = self.buffers[sock] = Buffer()
+        return buffer
+
+    def update(self, sock, buffer):
+        self.buffers[sock] = buffer
+
+    def free(self, sock):
+        self.buffers.pop(sock, None)
+
+    def split(self, data, buffer):
+        """Line splitter for :class:`circuits.protocols.line.Line`
+
+        Appends data to buffer in place and returns any complete lines
+        found along with the buffer holding the remaining partial line.
+        Empty lines are skipped.
+        """
+
+        limit = self.linelen - 2
+
+        if buffer.truncated:
+            end = data.find(b"\n")
+            if end == -1:
+                return [], buffer
+
+            # Keep the line break so the truncated line is completed
+            data = data[end:]
+            buffer.truncated = False
+
+        buffer.extend(data)
+
+        lines = []
+
+        start = 0
+        end = buffer.find(b"\n")
+        while end != -1:
+            stop = end - 1 if end > start and buffer[end - 1] == 0x0d else end
+            if stop > start:
+                lines.append(bytes(buffer[start:min(stop, start + limit)]))
+            start = end + 1
+            end = buffer.find(b"\n", start)
+
+        if start:
+            del buffer[:start]
+
+        if len(buffer) > limit:
+            del buffer[limit:]
+            buffer.truncated = True
+
+        return lines, buffer
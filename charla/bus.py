@@ -0,0 +1,268 @@
+"""Bus Module
+
+Cross-process message bus used when running several worker processes
+(see ``--workers``).
+
+Every worker keeps a replica of the users and channels of all the
+others, with remote users represented by a
+:class:`~charla.models.Remote` stand-in socket. The commands of local
+users that change shared state or deliver messages (:data:`COMMANDS`)
+are relayed to the other workers which run them against their replica,
+delivering the results to their own local users only; any other command
+received is refused. Whether a JOIN creates a channel, and so grants
+operator status, is decided by the worker of the joining user (see
+:meth:`charla.store.Store.found`). Other changes to users (host lookups,
+OPER) are sent as field updates. So are nick changes, which unlike the
+other commands depend on nick claims and so are only sent once accepted.
+
+Messages are batched and published on a Redis pub/sub channel once per
+event loop tick as part of the store's pipeline, so they are ordered
+with the writes they relate to.
+"""
+
+
+import json
+from threading import Thread
+from logging import getLogger
+
+
+from circuits import handler, Event, Component
+from circuits.protocols.irc import response, Message
+
+
+from .store import store
+from .events import broadcast
+from .models import channels, connections, Channel, Remote, User
+
+
+# Commands relayed to other workers
+COMMANDS = frozenset((
+    "join", "kick", "kill", "mode", "notice", "part", "privmsg", "quit",
+    "topic",
+))
+
+# User fields shared with other workers
+FIELDS = ("nick", "username", "hostname", "realname", "server", "flags", "away",)
+
+
+def apply(user, fields):
+    """Apply changes to the shared fields of a remote user
+
+    Returns a broadcast of the user's NICK to its local peers if an
+    existing nick was changed or else ``None``.
+    """
+
+    nick, prefix, invisible = user.nick, user.prefix, user.invisible
+
+    for field, value in fields.items():
+        setattr(user, field, value)
+
+    # Remote users are never written to Redis
+    user.dirty = None
+    user.save()
+
+    if user.invisible != invisible:
+        for channel in user.channels:
+            channel.nvisible += -1 if user.invisible else 1
+
+    if nick is None or user.nick == nick:
+        return
+
+    for channel in user.channels:
+        channel.invalidate()
+
+    peers = [peer for peer in user.peers if peer.local]
+    return broadcast(peers, Message(u"NICK", user.nick, prefix=prefix))
+
+
+def remove(user, reason):
+    """Remove a remote user that has gone without a QUIT of its own
+
+    Returns a broadcast of the QUIT to the user's local peers.
+    """
+
+    peers = [peer for peer in user.peers if peer.local]
+    quit = Message(u"QUIT", reason, prefix=user.prefix)
+
+    user.quit()
+    user.delete()
+
+    return broadcast(peers, quit)
+
+
+class relay(Event):
+    """relay Event"""
+
+
+class received(Event):
+    """received Event"""
+
+
+class Bus(Component):
+
+    channel = "bus"
+
+    def init(self, db, worker):
+        self.db = db
+        self.worker = worker
+
+        self.logger = getLogger(__name__)
+
+        self.key = store.key(u"bus")
+
+        # Messages to publish at the end of this tick
+        self.outbox = []
+
+        # Ids of local users the other workers know about
+        self.introduced = set()
+
+        self.pubsub = db.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(self.key)
+
+        self.thread = Thread(target=self.listen, name="bus")
+        self.thread.daemon = True
+        self.thread.start()
+
+        # Ask the other workers for their state
+        self.publish({u"t": u"sync"})
+
+    def listen(self):
+        for message in self.pubsub.listen():
+            if message["type"] == "message":
+                self.fire(received(message["data"]))
+
+    def publish(self, message):
+        self.outbox.append(message)
+
+    def introduce(self, user, force=False):
+        if user.id in self.introduced and not force:
+            return
+
+        self.introduced.add(user.id)
+
+        message = dict((field, getattr(user, field)) for field in FIELDS)
+        message.update({u"t": u"user", u"id": user.id})
+        self.publish(message)
+
+    def flush(self):
+        """Publish the messages of this tick with the store's pipeline
+
+        Must be called before :meth:`charla.store.Store.flush`. Changes
+        to local users saved during the tick are sent along as updates.
+        """
+
+        for model in store.dirty:
+            if isinstance(model, User) and model.registered:
+                self.update(model)
+
+        if not self.outbox:
+            return
+
+        data = json.dumps({u"w": self.worker, u"m": self.outbox})
+        store.pipeline().publish(self.key, data)
+
+        self.outbox = []
+
+    def update(self, user):
+        """Publish the shared fields of user changed since the last flush"""
+
+        if user.id not in self.introduced:
+            self.introduce(user)
+            return
+
+        if not user.dirty:
+            return
+
+        fields = dict(
+            (field, value) for field, value in user.dirty.items() if field in FIELDS
+        )
+        if fields:
+            fields.update({u"t": u"user", u"id": user.id})
+            self.publish(fields)
+
+    def relay(self, user, command, args):
+        # A nick change earlier in this tick must arrive first
+        self.update(user)
+        self.publish({u"t": u"cmd", u"id": user.id, u"c": command, u"a": args})
+
+        if command == "quit":
+            self.introduced.discard(user.id)
+
+    def received(self, data):
+        batch = json.loads(data)
+
+        worker = batch["w"]
+        if worker == self.worker:
+            return
+
+        for message in batch["m"]:
+            f = getattr(self, "_on_{0}".format(message["t"]), None)
+            if f is None:
+                self.logger.warn(u"Unknown bus message: {0}".format(message))
+                continue
+            f(worker, message)
+
+    @handler(False)
+    def _on_user(self, worker, message):
+        fields = dict((field, message[field]) for field in FIELDS if field in message)
+
+        user = connections.ids.get(message["id"])
+        if user is None:
+            user = User(id=message["id"], sock=Remote(worker), registered=True)
+
+        event = apply(user, fields)
+        if event is not None:
+            self.fire(event, "server")
+
+    @handler(False)
+    def _on_cmd(self, worker, message):
+        if message["c"] not in COMMANDS:
+            self.logger.warn(u"Refused bus command: {0}".format(message))
+            return
+
+        user = connections.ids.get(message["id"])
+        if user is None or user.local:
+            return
+
+        # Event names must be native strings, JSON decodes to unicode
+        self.fire(response.create(str(message["c"]), user.sock, user.source, *message["a"]), "server")
+
+    @handler(False)
+    def _on_sync(self, worker, message):
+        for user in connections:
+            if user.local and user.registered:
+                self.introduce(user, force=True)
+
+        for channel in channels:
+            members = [
+                (user.id, member.modes) for user, member in channel.members.items()
+                if user.local
+            ]
+            if members:
+                self.publish({
+                    u"t": u"channel", u"name": channel.name, u"flags": channel.flags,
+                    u"topic": channel.topic, u"members": members,
+                })
+
+    @handler(False)
+    def _on_channel(self, worker, message):
+        channel = channels.get(message["name"])
+        if channel is None:
+            channel = Channel(message["name"], flags=message["flags"], topic=message["topic"])
+
+        for id, modes in message["members"]:
+            user = connections.ids.get(id)
+            if user is not None and not user.local:
+                channel.join(user, modes)
+
+    @handler(False)
+    def _on_lost(self, worker, message):
+        """Drop the users of a worker process that has died"""
+
+        lost = [
+            user for user in connections
+            if not user.local and user.sock.worker == message["worker"]
+        ]
+
+        for user in lost:
+            self.fire(remove(user, u"Connection lost"), "server")
@@ -98,6 +98,108 @@ class Config(reprconf.Config):
             help="set database port to PORT (Redis)"
         )
 
+        add(
+            "--nameserver", action="store", default=None,
+            dest="nameserver", metavar="HOST",
+            help="resolve client hostnames using HOST (default: from /etc/resolv.conf)"
+        )
+
+        add(
+            "--lookupdeadline", action="store", type=int,
+            default=5, dest="lookupdeadline", metavar="SECONDS",
+            help="register clients by IP if their hostname is not found in SECONDS"
+        )
+
+        add(
+            "--writebehind", action="store_true", default=False,
+            dest="writebehind",
+            help="mirror state to the database from a background thread"
+        )
+
+        add(
+            "--writequeue", action="store", type=int,
+            default=64, dest="writequeue", metavar="BATCHES",
+            help="queue at most BATCHES pending writes in write-behind mode"
+        )
+
+        add(
+            "--keepdb", action="store_true", default=False,
+            dest="keepdb",
+            help="recover channel settings from the database instead of flushing it at boot"
+        )
+
+        add(
+            "--snapshot", action="store", default="charla.snap",
+            dest="snapshot", metavar="FILE",
+            help="keep channel settings across restarts in FILE"
+        )
+
+        add(
+            "--snapshotinterval", action="store", type=int,
+            default=300, dest="snapshotinterval", metavar="SECONDS",
+            help="write the snapshot every SECONDS (0 to disable)"
+        )
+
+        add(
+            "--snapshotbudget", action="store", type=float,
+            default=1.0, dest="snapshotbudget", metavar="SECONDS",
+            help="spend at most SECONDS loading the snapshot at boot"
+        )
+
+        add(
+            "--pinginterval", action="store", type=int,
+            default=120, dest="pinginterval", metavar="SECONDS",
+            help="PING clients idle for SECONDS"
+        )
+
+        add(
+            "--pingtimeout", action="store", type=int,
+            default=60, dest="pingtimeout", metavar="SECONDS",
+            help="disconnect clients not answering a PING within SECONDS"
+        )
+
+        add(
+            "--registertimeout", action="store", type=int,
+            default=60, dest="registertimeout", metavar="SECONDS",
+            help="disconnect clients not registered within SECONDS"
+        )
+
+        add(
+            "--workers", action="store", type=int,
+            default=1, dest="workers", metavar="N",
+            help="run N worker processes sharing the listening port"
+        )
+
+        add(
+            "--statefile", action="store", default="charla.state",
+            dest="statefile", metavar="FILE",
+            help="hand state over to the new process in FILE on RESTART"
+        )
+
+        add(
+            "--servername", action="store", default=None,
+            dest="servername", metavar="NAME",
+            help="name this server NAME on the network"
+        )
+
+        add(
+            "--linkport", action="store", type=int,
+            default=None, dest="linkport", metavar="PORT",
+            help="accept links from other servers on PORT"
+        )
+
+        add(
+            "--link", action="append", default=None,
+            dest="links", metavar="HOST:PORT",
+            help="link to the server on HOST:PORT (multiple allowed)"
+        )
+
+        add(
+            "--linkpassword", action="store", default=None,
+            dest="linkpassword", metavar="PASSWORD",
+            help="password servers must present to link (required to link)"
+        )
+
         add(
             "-p", "--plugin",
             action="append", default=plugins.DEFAULTS, dest="plugins",
@@ -111,6 +213,20 @@ class Config(reprconf.Config):
             help="Port to listen to"
         )
 
+        add(
+            "--sendq",
+            action="store", type=int,
+            default=1048576, dest="sendq", metavar="BYTES",
+            help="Disconnect clients with more than BYTES of pending output"
+        )
+
+        add(
+            "--linelen",
+            action="store", type=int,
+            default=512, dest="linelen", metavar="BYTES",
+            help="Truncate client lines longer than BYTES (including CRLF)"
+        )
+
         namespace = parser.parse_args()
 
         if namespace.config is not None:
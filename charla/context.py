@@ -0,0 +1,31 @@
+"""Context Module
+
+Per-request context resolved once by the processor for every inbound
+command and handed to command handlers and the reply path.
+"""
+
+
+class Context(object):
+
+    def __init__(self, sock, user=None):
+        self.sock = sock
+        self.user = user
+
+    def __repr__(self):
+        return "<Context {0} {1}>".format(self.sock, self.nick)
+
+    @property
+    def nick(self):
+        if self.user is None:
+            return
+        return self.user.nick
+
+    @property
+    def prefix(self):
+        if self.user is None:
+            return
+        return self.user.prefix
+
+    @property
+    def registered(self):
+        return self.user is not None and self.user.registered
@@ -10,29 +10,50 @@ Crates server component, load plugins and handles process signals.
 
 
 from logging import getLogger
+from threading import Thread
 from signal import SIGINT, SIGHUP, SIGTERM
 
 
-from circuits import handler, BaseComponent, Timer
+from circuits import handler, BaseComponent, Event, Timer
 
 from circuits.protocols.irc import Message
 
-from .models import User
+from . import snapshot
+from .bus import Bus
+from .store import store
+from .wheel import timers
+from .models import channels, connections
 from .server import Server
 from .plugins import Plugins
 from .events import broadcast, terminate
 
 
+class checkpoint(Event):
+    """checkpoint Event"""
+
+
 class Core(BaseComponent):
 
     channel = "core"
 
-    def init(self, config, db):
+    def init(self, config, db, worker=0):
         self.config = config
         self.db = db
 
         self.logger = getLogger(__name__)
 
+        if config["workers"] > 1:
+            self.bus = Bus(db, worker).register(self)
+        else:
+            self.bus = None
+
+        # Only one worker writes the snapshot, they all hold every channel
+        self.snapshot = config["snapshot"] if worker == 0 else None
+        self.writer = None
+
+        if self.snapshot and config["snapshotinterval"]:
+            Timer(config["snapshotinterval"], checkpoint(), self.channel, persist=True).register(self)
+
         self.server = Server(self.config, self.db).register(self)
 
         self.plugins = Plugins(
@@ -51,13 +72,49 @@ class Core(BaseComponent):
             Timer(5, terminate()).register(self)
             self.fire(
                 broadcast(
-                    User.objects,
+                    connections,
                     Message("NOTICE", "Received SIGTERM, terminating...")
                 ),
                 self.server
             )
         return True
 
+    @handler("generate_events", channel="*")
+    def generate_events(self, event):
+        timers.advance()
+
+        # Wake up for the next tick when idle
+        event.reduce_time_left(timers.timeout())
+
+        if self.bus is not None:
+            self.bus.flush()
+
+        store.flush()
+
+    @handler("checkpoint")
+    def checkpoint(self):
+        """Write the snapshot from a background thread"""
+
+        if self.writer is not None and self.writer.is_alive():
+            return
+
+        self.writer = Thread(
+            target=snapshot.write, args=(self.snapshot, channels.settings()), name="snapshot"
+        )
+        self.writer.daemon = True
+        self.writer.start()
+
     @handler("terminate")
     def terminate(self):
+        if self.bus is not None:
+            self.bus.flush()
+
+        store.flush()
+        store.stop()
+
+        if self.snapshot:
+            if self.writer is not None:
+                self.writer.join()
+            snapshot.write(self.snapshot, channels.settings())
+
         raise SystemExit(0)
@@ -12,19 +12,27 @@ Main entry point responsible for configuring and starting the application.
 """
 
 
+import os
 import sys
+import json
 import logging
+from errno import EINTR
+from datetime import datetime
 from logging import getLogger
+from signal import signal, SIGHUP, SIGINT, SIGTERM, SIG_DFL
 
 
 from circuits.app import Daemon
 from circuits import Debugger, Manager, Worker
 
-from redisco import connection_setup, get_client
+from redis import StrictRedis
 
 
 from .core import Core
+from .store import store
 from .utils import waitfor
+from . import snapshot
+from .models import channels, load_datetime, partition, Settings
 from .config import Config
 
 
@@ -57,22 +65,163 @@ def setup_database(config, logger):
         "Connecting to Redis on {0:s}:{1:d} ...".format(dbhost, dbport)
     )
 
-    connection_setup(host=dbhost, port=dbport)
+    db = StrictRedis(host=dbhost, port=dbport)
 
     logger.debug("Success!")
 
-    db = get_client()
-    db.flushall()
+    store.db = db
+
+    if config["keepdb"]:
+        hashes = store.recover()
+    else:
+        db.flushall()
+        hashes = []
+
+    warmstart(config, logger, hashes)
 
     return db
 
 
-def main():
-    config = Config()
+def warmstart(config, logger, hashes):
+    """Restore the settings of channels from the snapshot
 
-    logger = setup_logging(config)
+    Settings recovered from the channel hashes left in Redis take
+    precedence as they are more recent.
+    """
 
-    db = setup_database(config, logger)
+    if config["snapshot"]:
+        channels.restore(snapshot.read(config["snapshot"], config["snapshotbudget"]))
+
+    settings = []
+    for fields in hashes:
+        if not fields.get(b"name"):
+            continue
+
+        topic = fields.get(b"topic")
+        created = fields.get(b"created")
+
+        settings.append(Settings(
+            fields[b"name"].decode("utf-8"),
+            int(fields.get(b"flags") or 0),
+            topic.decode("utf-8") if topic is not None else None,
+            load_datetime(created.decode("ascii")) if created else datetime.utcnow(),
+        ))
+
+    channels.restore(settings)
+
+    if settings:
+        logger.info("Recovered {0} channel(s) from Redis".format(len(settings)))
+
+
+def daemonize(pidfile):
+    """Detach the supervisor of several workers from the terminal"""
+
+    if os.fork():
+        os._exit(0)
+
+    os.setsid()
+
+    if os.fork():
+        os._exit(0)
+
+    with open(pidfile, "w") as f:
+        f.write(str(os.getpid()))
+
+
+def lost(db, worker, n):
+    """Clean up after a worker process that has died
+
+    The other workers are told to drop its users, the nicks and channels
+    it had claimed are released and the records of its users are deleted.
+    """
+
+    message = {u"w": -1, u"m": [{u"t": u"lost", u"worker": worker}]}
+    db.publish(store.key(u"bus"), json.dumps(message))
+
+    for key in (store.key(u"nicks"), store.key(u"founders")):
+        names = [name for name, id in db.hgetall(key).items() if (int(id) - 1) % n == worker]
+        if names:
+            db.hdel(key, *names)
+
+    # charla:user:<id> and charla:user:<id>:channels
+    ids = set()
+    for key in db.scan_iter(match=store.key(u"user", u"*"), count=1000):
+        id = key.decode("utf-8").split(u":")[2]
+        if id.isdigit() and (int(id) - 1) % n == worker:
+            ids.add(int(id))
+
+    pipe = db.pipeline(transaction=False)
+    for id in ids:
+        for name in db.smembers(store.key(u"user", id, u"channels")):
+            pipe.hdel(store.key(u"channel", name.decode("utf-8"), u"members"), id)
+        pipe.delete(store.key(u"user", id), store.key(u"user", id, u"channels"))
+    pipe.execute()
+
+
+def supervise(config, db, logger):
+    """Run and restart config["workers"] worker processes"""
+
+    n = config["workers"]
+
+    # pid -> worker
+    children = {}
+
+    state = {"stopping": False}
+
+    def spawn(worker):
+        pid = os.fork()
+        if pid:
+            children[pid] = worker
+            return
+
+        for signo in (SIGHUP, SIGINT, SIGTERM):
+            signal(signo, SIG_DFL)
+
+        try:
+            run(config, db, logger, worker)
+        finally:
+            os._exit(0)
+
+    def forward(signo, stack):
+        if signo in (SIGINT, SIGTERM):
+            state["stopping"] = True
+
+        for pid in children:
+            os.kill(pid, signo)
+
+    if config["daemon"]:
+        daemonize(config["pidfile"])
+
+    for worker in range(n):
+        spawn(worker)
+
+    for signo in (SIGHUP, SIGINT, SIGTERM):
+        signal(signo, forward)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == EINTR:
+                continue
+            raise
+
+        worker = children.pop(pid, None)
+        if worker is None or state["stopping"]:
+            continue
+
+        logger.warn("Worker {0:d} exited with status {1:d}, restarting".format(worker, status))
+
+        lost(db, worker, n)
+        spawn(worker)
+
+
+def run(config, db, logger, worker=0):
+    if config["workers"] > 1:
+        partition(worker, config["workers"])
+
+    if config["writebehind"]:
+        store.start(config["writequeue"])
 
     manager = Manager()
 
@@ -84,13 +233,26 @@ def main():
             events=config["verbose"],
         ).register(manager)
 
-    if config["daemon"]:
+    if config["daemon"] and config["workers"] == 1:
         Daemon(config["pidfile"]).register(manager)
 
-    Core(config, db).register(manager)
+    Core(config, db, worker).register(manager)
 
     manager.run()
 
 
+def main():
+    config = Config()
+
+    logger = setup_logging(config)
+
+    db = setup_database(config, logger)
+
+    if config["workers"] > 1:
+        supervise(config, db, logger)
+    else:
+        run(config, db, logger)
+
+
 if __name__ == "__main__":
     main()
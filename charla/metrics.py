@@ -0,0 +1,98 @@
+"""Metrics Module
+
+Lightweight in-process counters, gauges and histograms used to
+instrument hot paths. Operators can inspect them with ``STATS m``.
+"""
+
+
+from bisect import bisect_left
+from collections import defaultdict
+
+
+# Histogram bucket bounds for durations in seconds
+BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 50, 100, 500, 1000)
+
+# Histogram bucket bounds for the time from connecting to being
+# welcomed, fine enough to see clients held up to the lookup deadline
+REGISTRATION = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 3, 4, 5, 6, 8, 10, 30, 60)
+
+# Histogram bucket bounds for counts of things such as recipients
+COUNTS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 50000, 100000)
+
+
+class Histogram(object):
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def __repr__(self):
+        return "<Histogram count={0} avg={1:g} max={2:g}>".format(
+            self.count, self.avg, self.max
+        )
+
+    @property
+    def avg(self):
+        return float(self.total) / self.count if self.count else 0.0
+
+    def observe(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def distribution(self):
+        """Return the non-empty buckets as ``<=bound:count`` pairs"""
+
+        labels = [u"<={0:g}".format(bound) for bound in self.bounds]
+        labels.append(u">{0:g}".format(self.bounds[-1]))
+
+        return u" ".join(
+            u"{0}:{1}".format(label, n) for label, n in zip(labels, self.buckets) if n
+        )
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.histograms = {}
+        self.gauges = {}
+
+    def incr(self, name, n=1):
+        self.counters[name] += n
+
+    def gauge(self, name, f):
+        """Register a callable f returning the current value of name"""
+
+        self.gauges[name] = f
+
+    def observe(self, name, value, bounds=BOUNDS):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(bounds)
+        histogram.observe(value)
+
+    def report(self):
+        for name in sorted(self.counters):
+            yield u"{0}: {1}".format(name, self.counters[name])
+
+        for name in sorted(self.gauges):
+            yield u"{0}: {1}".format(name, self.gauges[name]())
+
+        for name in sorted(self.histograms):
+            histogram = self.histograms[name]
+            line = u"{0}: count={1} avg={2:g} max={3:g}".format(
+                name, histogram.count, histogram.avg, histogram.max
+            )
+            distribution = histogram.distribution()
+            yield u"{0} {1}".format(line, distribution) if distribution else line
+
+
+metrics = Metrics()
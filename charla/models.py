@@ -1,76 +1,623 @@
 """Data Models"""
 
 
-from operator import attrgetter
-from socket import socket, error as SocketError
+from time import time
+from datetime import datetime
+from itertools import count
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right
+from socket import error as SocketError
 
 
-from bidict import bidict
-
 from circuits.protocols.irc import joinprefix
 
-from redisco.models import Model
-from redisco.models import Attribute, BooleanField, DateTimeField
-from redisco.models import IntegerField, ListField, ReferenceField
+from .store import store
+from .utils import casefold
+
+
+class Field(object):
+    """Model attribute that records itself as dirty when assigned
+
+    Values are kept in a slot named after the field with a leading
+    underscore. ``dump`` converts a value into the form it is stored in
+    Redis. ``default`` may be a callable returning a fresh default value.
+    """
+
+    def __init__(self, default=None, dump=None):
+        self.name = None
+        self.slot = None
+        self.default = default
+        self.dump = dump
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            return self
+        return getattr(obj, self.slot)
+
+    def __set__(self, obj, value):
+        if getattr(obj, self.slot, Field) == value:
+            return
+
+        setattr(obj, self.slot, value)
+
+        if obj.dirty is None:
+            obj.dirty = {}
+        obj.dirty[self.name] = value if self.dump is None else self.dump(value)
+
+
+class SourceField(Field):
+    """Field making up part of a user's ``nick!user@host`` prefix
+
+    Assigning it discards the user's cached prefix.
+    """
+
+    def __set__(self, obj, value):
+        super(SourceField, self).__set__(obj, value)
+        obj._prefix = None
+
+
+def dump_bool(value):
+    return int(bool(value))
+
+
+def dump_datetime(value):
+    return value.isoformat()
+
+
+def load_datetime(value):
+    """Parse a datetime written by :func:`dump_datetime`"""
+
+    if "." in value:
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f")
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S")
+
+
+def dump_sock(value):
+    try:
+        return value.fileno()
+    except (AttributeError, SocketError):
+        # Closed or Remote
+        return None
+
+
+class ModelType(type):
+    """Metaclass of :class:`Model`
+
+    Gives every model ``__slots__`` holding its fields so live objects
+    carry no per-instance ``__dict__``.
+    """
 
+    def __new__(mcs, name, bases, attrs):
+        slots = list(attrs.get("__slots__", ()))
+        for key, value in attrs.items():
+            if isinstance(value, Field):
+                value.name = key
+                value.slot = "_{0}".format(key)
+                slots.append(value.slot)
 
-class SocketField(Attribute):
+        attrs["__slots__"] = tuple(slots)
 
-    cache = bidict()
+        return super(ModelType, mcs).__new__(mcs, name, bases, attrs)
 
-    def typecast_for_read(self, value):
-        return self.cache.get(int(value), None)
+    def __init__(cls, name, bases, attrs):
+        super(ModelType, cls).__init__(name, bases, attrs)
 
-    def typecast_for_storage(self, value):
-        if value is None:
-            return None
+        cls.fields = {}
+        for base in reversed(cls.__mro__):
+            for key, value in vars(base).items():
+                if isinstance(value, Field):
+                    cls.fields[key] = value
 
-        try:
-            fd = value.fileno()
-            self.cache[fd] = value
-            return fd
-        except SocketError:
-            try:
-                fd = self.cache[:value]
-                self.cache[fd] = value
-                return fd
-            except KeyError:
-                return None
+        cls.ids = count(1)
 
-    def value_type(self):
-        return socket
 
-    def acceptable_types(self):
-        return self.value_type()
+class Modes(object):
+    """Mixin keeping single letter modes as bit flags in ``flags``
 
+    Bit n of ``flags`` is the n'th letter of ``MODES``.
+    """
 
-class User(Model):
+    __slots__ = ()
 
-    sock = SocketField(required=True)
-    host = Attribute(default="")
-    port = IntegerField(default=0)
+    MODES = u""
 
-    nick = Attribute(default=None)
-    away = Attribute(default=None)
-    modes = Attribute(default="")
+    @classmethod
+    def flag(cls, mode):
+        return 1 << cls.MODES.index(mode)
 
-    channels = ListField("Channel")
-    userinfo = ReferenceField("UserInfo")
+    @classmethod
+    def parse(cls, modes):
+        """Return the flags of the given mode letters"""
 
-    registered = BooleanField(default=False)
-    signon = DateTimeField(auto_now_add=True)
+        flags = 0
+        for mode in modes:
+            flags |= cls.flag(mode)
+        return flags
+
+    @property
+    def modes(self):
+        return u"".join(
+            mode for i, mode in enumerate(self.MODES) if self.flags & (1 << i)
+        )
+
+    def has_mode(self, mode):
+        return bool(self.flags & self.flag(mode))
+
+    def set_mode(self, mode, value=True):
+        """Set or clear mode returning ``False`` if it was unchanged"""
+
+        flag = self.flag(mode)
+        flags = self.flags | flag if value else self.flags & ~flag
+        if flags == self.flags:
+            return False
+
+        self.flags = flags
+        return True
+
+
+class Model(object):
+    """Base class of persisted models
+
+    Unlike redisco models nothing is written on :meth:`save`; the object
+    is handed to :data:`charla.store.store` which writes only the fields
+    assigned since the last flush, once per event loop tick, in a single
+    pipeline along with every other object saved during that tick.
+    """
+
+    __metaclass__ = ModelType
+
+    __slots__ = ("id", "dirty",)
+
+    def __init__(self, **kwargs):
+        self.id = kwargs.pop("id", None) or next(self.ids)
+
+        # field name -> dumped value of fields not yet written to Redis
+        self.dirty = None
+
+        for name, field in self.fields.items():
+            if name in kwargs:
+                value = kwargs.pop(name)
+            elif callable(field.default):
+                value = field.default()
+            else:
+                value = field.default
+            setattr(self, name, value)
+
+        if kwargs:
+            raise TypeError("Unknown fields: {0}".format(", ".join(kwargs)))
+
+        # Nothing to remove from a hash that has never been written
+        for name, value in list(self.dirty.items()):
+            if value is None:
+                del self.dirty[name]
 
     def __repr__(self):
-        attrs = self.attributes_dict.copy()
-        attrs["channels"] = map(attrgetter("name"), attrs["channels"])
+        return "<{0} {1}>".format(self.key(), self.attributes)
+
+    @property
+    def attributes(self):
+        return dict((name, getattr(self, name)) for name in self.fields)
+
+    def key(self):
+        return store.key(self.__class__.__name__.lower(), self.id)
+
+    def save(self):
+        store.save(self)
+
+    def delete(self):
+        store.delete(self)
+
+
+def partition(index, n):
+    """Allocate ids so the models of n worker processes never collide
+
+    Worker index (counting from 0) is given the ids ``index + 1``,
+    ``index + 1 + n``, ``index + 1 + 2n`` and so on.
+    """
+
+    for model in (User, Channel):
+        model.ids = count(index + 1, n)
+
+
+class Remote(object):
+    """Stand-in socket of a user connected to another worker process
+    or to another server linked to this one
+
+    Remote users are kept in the same tables as local ones so that
+    lookups, LUSERS and channel membership are global, but nothing is
+    ever written to them and they are not mirrored to Redis.
+    """
+
+    __slots__ = ("worker", "server",)
+
+    def __init__(self, worker=None, server=None):
+        self.worker = worker
+        self.server = server
+
+    def __repr__(self):
+        if self.server is not None:
+            return "<Remote server={0}>".format(self.server)
+        return "<Remote worker={0}>".format(self.worker)
+
+
+class Connections(object):
+    """In-process table of connected users
+
+    This is the authoritative index of live users keyed by socket with
+    secondary indexes by casefolded nick and by id. Redis is kept as a mirror;
+    :class:`User` keeps this table up to date when saved or deleted.
+
+    The table also maintains the counters reported by LUSERS so they
+    never require a scan of all users.
+    """
+
+    def __init__(self):
+        self.socks = {}
+        self.nicks = {}
+        self.ids = {}
+
+        # sock -> casefolded nick the user is currently indexed under
+        self.names = {}
+
+        # sock -> (registered, invisible, oper, local) the user is counted as
+        self.flags = {}
+
+        self.nusers = 0
+        self.nunknown = 0
+        self.ninvisible = 0
+        self.noperators = 0
+        self.maxusers = 0
+
+        # Registered users connected to this process
+        self.nlocal = 0
+        self.maxlocal = 0
+
+    def __len__(self):
+        return len(self.socks)
+
+    def __iter__(self):
+        return iter(self.socks.values())
+
+    def __contains__(self, sock):
+        return sock in self.socks
+
+    def get(self, sock):
+        return self.socks.get(sock)
+
+    def find(self, nick):
+        return self.nicks.get(casefold(nick))
+
+    def count(self, flags, n):
+        registered, invisible, oper, local = flags
+        if registered:
+            self.nusers += n
+            if local:
+                self.nlocal += n
+            if invisible:
+                self.ninvisible += n
+            if oper:
+                self.noperators += n
+        else:
+            self.nunknown += n
+
+    def update(self, user):
+        sock = user.sock
+        self.socks[sock] = user
+        self.ids[user.id] = user
+
+        flags = (user.registered, user.invisible, user.oper, user.local)
+        counted = self.flags.get(sock)
+        if counted != flags:
+            if counted is not None:
+                self.count(counted, -1)
+            self.count(flags, 1)
+            self.flags[sock] = flags
+            self.maxusers = max(self.maxusers, self.nusers)
+            self.maxlocal = max(self.maxlocal, self.nlocal)
+
+        key = casefold(user.nick) if user.nick else None
+
+        nick = self.names.get(sock)
+        if nick == key:
+            return
+
+        if nick is not None and self.nicks.get(nick) is user:
+            del self.nicks[nick]
+
+        if key is not None:
+            self.nicks[key] = user
+
+        self.names[sock] = key
+
+    def remove(self, user):
+        sock = user.sock
+        if self.socks.get(sock) is not user:
+            return
+
+        del self.socks[sock]
+        self.ids.pop(user.id, None)
+
+        self.count(self.flags.pop(sock), -1)
+
+        nick = self.names.pop(sock, None)
+        if nick is not None and self.nicks.get(nick) is user:
+            del self.nicks[nick]
+
+
+connections = Connections()
+
+
+class Settings(object):
+    """Persistent settings of a channel"""
+
+    __slots__ = ("name", "flags", "topic", "created",)
+
+    def __init__(self, name, flags, topic, created):
+        self.name = name
+        self.flags = flags
+        self.topic = topic
+        self.created = created
+
+    @classmethod
+    def of(cls, channel):
+        return cls(channel.name, channel.flags, channel.topic, channel.created)
+
+
+class Channels(object):
+    """In-process table of channels keyed by casefolded name
+
+    Like :class:`Connections` this is authoritative and Redis is only a
+    mirror; :class:`Channel` keeps it up to date as members come and go.
+
+    The table doubles as the channel directory used by LIST: it keeps
+    the casefolded names in sorted order so channels can be searched
+    by name prefix without scanning the whole table.
+
+    It also keeps the settings (modes and topic) of channels that have
+    lost their last member and gives them back when the channel is next
+    created. These are what :mod:`charla.snapshot` persists across
+    restarts. They are kept for ``ttl`` seconds and for at most
+    ``limit`` channels, the oldest being forgotten first.
+    """
+
+    def __init__(self, ttl=7 * 24 * 60 * 60, limit=10000, clock=time):
+        self.names = {}
+
+        # sorted casefolded names
+        self.index = []
+
+        self.ttl = ttl
+        self.limit = limit
+        self.clock = clock
+
+        # casefolded name -> (Settings, expiry time) of channels without
+        # members, oldest first
+        self.saved = OrderedDict()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names.values())
+
+    def __contains__(self, name):
+        return casefold(name) in self.names
+
+    def get(self, name):
+        return self.names.get(casefold(name))
+
+    def search(self, prefix=u""):
+        """Iterate over channels whose name starts with prefix in name order
+
+        Safe to use from a long running generator: channels created or
+        deleted between iterations are simply picked up or skipped.
+        """
+
+        prefix = casefold(prefix)
+
+        i = bisect_left(self.index, prefix)
+        while i < len(self.index):
+            key = self.index[i]
+            if not key.startswith(prefix):
+                return
+
+            yield self.names[key]
+
+            i = bisect_right(self.index, key)
+
+    def update(self, channel):
+        key = casefold(channel.name)
+        if key not in self.names:
+            self.index.insert(bisect_left(self.index, key), key)
+
+            saved, expires = self.saved.pop(key, (None, 0))
+            if expires > self.clock() and not channel.flags and channel.topic is None:
+                channel.flags = saved.flags
+                channel.topic = saved.topic
+                channel.created = saved.created
+
+        self.names[key] = channel
+
+    def remove(self, channel):
+        key = casefold(channel.name)
+        if self.names.get(key) is channel:
+            del self.names[key]
+            del self.index[bisect_left(self.index, key)]
+
+            if channel.flags or channel.topic is not None:
+                self.keep(key, Settings.of(channel))
+
+    def keep(self, key, settings):
+        self.saved.pop(key, None)
+        self.saved[key] = (settings, self.clock() + self.ttl)
+        self.expire()
+
+    def expire(self):
+        """Forget expired settings and the oldest ones over the limit"""
+
+        now = self.clock()
+        while self.saved:
+            key = next(iter(self.saved))
+            if len(self.saved) <= self.limit and self.saved[key][1] > now:
+                break
+            del self.saved[key]
+
+    def settings(self):
+        """Return the settings of every channel worth keeping"""
+
+        self.expire()
 
-        key = self.__class__.__name__ if self.is_new() else self.key()
+        settings = dict((key, entry) for key, (entry, expires) in self.saved.items())
+        for key, channel in self.names.items():
+            if channel.flags or channel.topic is not None:
+                settings[key] = Settings.of(channel)
+        return list(settings.values())
 
-        return "<{0} {1}>".format(key, attrs)
+    def restore(self, settings):
+        """Keep settings for channels that do not exist yet"""
+
+        for entry in settings:
+            key = casefold(entry.name)
+            if key not in self.names:
+                self.keep(key, entry)
+
+
+channels = Channels()
+
+
+class Peer(object):
+    """A server linked to this one, directly or through other servers
+
+    ``uplink`` is the name of the server it is linked to and ``via``
+    the name of the directly linked server it is reached through.
+    """
+
+    __slots__ = ("name", "info", "hops", "uplink", "via",)
+
+    def __init__(self, name, info, hops, uplink, via):
+        self.name = name
+        self.info = info
+        self.hops = hops
+        self.uplink = uplink
+        self.via = via
+
+    def __repr__(self):
+        return "<Peer {0} via {1}>".format(self.name, self.via)
+
+
+class Servers(object):
+    """In-process table of the other servers of the network keyed by
+    casefolded name
+    """
+
+    def __init__(self):
+        self.names = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names.values())
+
+    def __contains__(self, name):
+        return casefold(name) in self.names
+
+    def get(self, name):
+        return self.names.get(casefold(name))
+
+    def update(self, peer):
+        self.names[casefold(peer.name)] = peer
+
+    def remove(self, peer):
+        self.names.pop(casefold(peer.name), None)
+
+
+servers = Servers()
+
+
+class User(Modes, Model):
+
+    MODES = u"io"
+
+    INVISIBLE = 1 << 0
+    OPERATOR = 1 << 1
+
+    __slots__ = ("_prefix", "channels",)
+
+    sock = Field(dump=dump_sock)
+    host = Field(default=u"")
+    port = Field(default=0)
+
+    nick = SourceField()
+    away = Field()
+    flags = Field(default=0)
+
+    # Set by the USER command and host lookup
+    username = SourceField()
+    hostname = SourceField()
+    realname = Field()
+    server = Field()
+
+    registered = Field(default=False, dump=dump_bool)
+    signon = Field(default=datetime.utcnow, dump=dump_datetime)
+
+    def __init__(self, **kwargs):
+        super(User, self).__init__(**kwargs)
+
+        # Cached nick!user@host (see prefix)
+        self._prefix = None
+
+        # Channels this user is a member of (see Channel.members)
+        self.channels = set()
+
+    def __repr__(self):
+        attrs = self.attributes
+        attrs["channels"] = [channel.name for channel in self.channels]
+
+        return "<{0} {1}>".format(self.key(), attrs)
+
+    def save(self):
+        if self.local:
+            super(User, self).save()
+        connections.update(self)
+
+    def delete(self):
+        connections.remove(self)
+        if self.local:
+            super(User, self).delete()
+
+    def quit(self):
+        """Remove this user from all of its channels at once"""
+
+        left = [channel for channel in list(self.channels) if channel.leave(self)]
+        if self.local:
+            store.quit(self, left)
+
+    @property
+    def local(self):
+        """``False`` if this user is connected to another worker or server"""
+
+        return not isinstance(self.sock, Remote)
+
+    @property
+    def origin(self):
+        """Name of the linked server this user is on or ``None`` for this one"""
+
+        return None if self.local else self.sock.server
+
+    @property
+    def peers(self):
+        """Set of users sharing at least one channel with this user
+
+        Each peer appears once however many channels are shared; the
+        set includes this user if it is in any channel.
+        """
+
+        return set().union(*(channel.members for channel in self.channels))
 
     @property
     def oper(self):
-        return "o" in self.modes
+        return bool(self.flags & self.OPERATOR)
 
     @property
     def visible(self):
@@ -78,69 +625,219 @@ class User(Model):
 
     @property
     def invisible(self):
-        return "i" in self.modes
+        return bool(self.flags & self.INVISIBLE)
 
     @property
     def prefix(self):
-        userinfo = self.userinfo
-        if userinfo is None:
-            return
-        return joinprefix(*self.source)
+        if self._prefix is None and self.username is not None:
+            self._prefix = joinprefix(*self.source)
+        return self._prefix
 
     @property
     def source(self):
-        userinfo = self.userinfo
-        if userinfo is None:
+        if self.username is None:
             return
-        return self.nick, userinfo.user, userinfo.host
+        return self.nick, self.username, self.hostname
 
-    class Meta:
-        indices = ("id", "sock", "nick",)
 
+class Channel(Modes, Model):
+    """Live channel
 
-class UserInfo(Model):
+    Channels only exist in-process while they have members and are
+    mirrored to Redis by :mod:`charla.store`.
+    """
 
-    user = Attribute(default=None)
-    host = Attribute(default=None)
-    server = Attribute(default=None)
-    name = Attribute(default=None)
+    MODES = u"mnt"
 
-    def __nonzero__(self):
-        return all(x is not None for x in (self.user, self.host, self.name))
+    MODERATED = 1 << 0
+    NOEXTERNAL = 1 << 1
+    TOPICLOCK = 1 << 2
 
+    __slots__ = ("members", "namereplies", "nvisible", "founder",)
 
-class Channel(Model):
+    name = Field()
+    flags = Field(default=0)
+    topic = Field()
+    created = Field(default=datetime.utcnow, dump=dump_datetime)
 
-    name = Attribute(required=True, unique=True)
-    users = ListField("User")
-    modes = Attribute(default="")
-    topic = Attribute(default=None)
-    operators = ListField("User")
-    voiced = ListField("User")
+    def __init__(self, name, **kwargs):
+        super(Channel, self).__init__(name=name, **kwargs)
+
+        # user -> Member
+        self.members = {}
+
+        # (width, chunks) of the rendered NAMES reply (see namereply)
+        self.namereplies = None
+
+        # Number of members without user mode +i
+        self.nvisible = 0
+
+        # Id of the founding user when shared by workers (see Store.found)
+        self.founder = 0
 
     def __repr__(self):
-        attrs = self.attributes_dict.copy()
-        attrs["users"] = map(attrgetter("nick"), attrs["users"])
+        attrs = self.attributes
+        attrs["users"] = [user.nick for user in self.members]
 
-        if not self.is_new():
-            return "<%s %s>" % (self.key(), attrs)
+        return "<{0} {1}>".format(self.key(), attrs)
 
-        return "<%s %s>" % (self.__class__.__name__, attrs)
+    def key(self):
+        return store.channel_key(self)
 
     @property
     def type(self):
         return self.name[0]
 
+    @property
+    def users(self):
+        return list(self.members)
+
     @property
     def userprefixes(self):
-        def prefix(user):
-            if user in self.operators:
-                return "@{0}".format(user.nick)
-            if user in self.voiced:
-                return "+{0}".format(user.nick)
-            return user.nick
+        return sorted(
+            u"{0}{1}".format(member.prefix, user.nick)
+            for user, member in self.members.items()
+        )
+
+    def namereply(self, width):
+        """Return the NAMES list of this channel split into chunks
+
+        Each chunk is a list of prefixed nicks whose space separated
+        length is at most width bytes. The result is cached until
+        :meth:`invalidate` is called.
+        """
+
+        if self.namereplies is None or self.namereplies[0] != width:
+            chunks, chunk, size = [], [], 0
+            for name in self.userprefixes:
+                n = len(name.encode("utf-8"))
+                if chunk and size + 1 + n > width:
+                    chunks.append(chunk)
+                    chunk, size = [], 0
+                size += n + 1 if chunk else n
+                chunk.append(name)
+
+            if chunk:
+                chunks.append(chunk)
+
+            self.namereplies = (width, chunks)
+
+        return self.namereplies[1]
+
+    def invalidate(self):
+        """Invalidate the cached NAMES reply
+
+        Must be called whenever a member joins, leaves, changes nick or
+        has its privileges changed.
+        """
+
+        self.namereplies = None
+
+    def is_operator(self, user):
+        member = self.members.get(user)
+        return member is not None and member.operator
+
+    def is_voiced(self, user):
+        member = self.members.get(user)
+        return member is not None and member.voiced
+
+    def join(self, user, modes=u""):
+        """Add user to this channel with the given privileges
+
+        A channel that has no members yet is created. Returns the new
+        :class:`Member` or ``None`` if user is already a member.
+        """
+
+        if user in self.members:
+            return
+
+        new = not self.members
+        if new:
+            channels.update(self)
+
+        member = Member(user, self, Member.parse(modes))
+
+        self.members[user] = member
+        user.channels.add(self)
+        self.invalidate()
+
+        if user.visible:
+            self.nvisible += 1
+
+        if user.local:
+            store.join(self, member, new)
 
-        return map(prefix, sorted(self.users, key=prefix))
+        return member
 
-    class Meta:
-        indices = ("id", "name",)
+    def leave(self, user):
+        """Remove user from this channel in-process only
+
+        The channel is removed from the channel table and its founding
+        released once its last member has left. Returns ``False`` if user
+        was not a member.
+        """
+
+        member = self.members.pop(user, None)
+        if member is None:
+            return False
+
+        user.channels.discard(self)
+        self.invalidate()
+
+        if user.visible:
+            self.nvisible -= 1
+
+        if not self.members:
+            channels.remove(self)
+            store.disband(self)
+
+        return True
+
+    def part(self, user):
+        """Remove user from this channel
+
+        The channel is deleted once its last member has left.
+        """
+
+        if self.leave(user) and user.local:
+            store.part(self, user)
+
+
+class Member(Modes):
+    """Channel membership of a single user with its privileges"""
+
+    MODES = u"ov"
+
+    OPERATOR = 1 << 0
+    VOICED = 1 << 1
+
+    __slots__ = ("user", "channel", "flags",)
+
+    def __init__(self, user, channel, flags=0):
+        self.user = user
+        self.channel = channel
+        self.flags = flags
+
+    def __repr__(self):
+        return "<%s %s%s %s>" % (
+            self.__class__.__name__, self.prefix, self.user.nick, self.channel.name
+        )
+
+    def save(self):
+        store.save_member(self)
+
+    @property
+    def operator(self):
+        return bool(self.flags & self.OPERATOR)
+
+    @property
+    def voiced(self):
+        return bool(self.flags & self.VOICED)
+
+    @property
+    def prefix(self):
+        if self.flags & self.OPERATOR:
+            return u"@"
+        if self.flags & self.VOICED:
+            return u"+"
+        return u""
@@ -21,7 +21,8 @@ from ..plugin import BasePlugin
 
 DEFAULTS = (
     "admin", "autojoin", "cap", "core", "channel", "checkhost", "debug",
-    "message", "mode", "user", "ping", "processor", "welcome", "version",
+    "link", "message", "mode", "user", "ping", "processor", "welcome",
+    "version",
 )
 
 
@@ -1,26 +1,36 @@
 import os
 import sys
 from fnmatch import fnmatch
+from operator import itemgetter
+from socket import error as SocketError
 
 
-from circuits import Timer
 from circuits.net.events import close
 from circuits.protocols.irc import reply, response
-from circuits.protocols.irc.replies import Message, ERR_NOSUCHNICK, ERROR
+from circuits.protocols.irc.replies import _M, Message, ERR_NOSUCHNICK, ERROR
 from circuits.protocols.irc.replies import ERR_NOOPERHOST, ERR_NOPRIVILEGES
 from circuits.protocols.irc.replies import ERR_PASSWDMISMATCH, RPL_YOUREOPER
 
 
-from ..models import User
+from .. import snapshot
+from ..store import store
+from ..wheel import timers
+from ..metrics import metrics
+from ..models import connections
 from ..plugin import BasePlugin
+from ..resolver import normalize
 from ..commands import BaseCommands
 from ..plugins import load, query, unload
 
 
+def RPL_ENDOFSTATS(query):
+    return _M(u"219", query, u"End of /STATS report")
+
+
 class Commands(BaseCommands):
 
-    def oper(self, sock, source, name, password):
-        user = User.objects.filter(sock=sock).first()
+    def oper(self, event, sock, source, name, password):
+        user = event.context.user
         if user.oper:
             return
 
@@ -30,14 +40,14 @@ class Commands(BaseCommands):
             return ERR_NOOPERHOST()
 
         if (name, password) == oline:
-            user.modes += u"o"
+            user.set_mode(u"o")
             user.save()
             return RPL_YOUREOPER()
 
         return ERR_PASSWDMISMATCH()
 
-    def load(self, sock, source, name):
-        user = User.objects.filter(sock=sock).first()
+    def load(self, event, sock, source, name):
+        user = event.context.user
         if not user.oper:
             yield ERR_NOPRIVILEGES()
             return
@@ -47,8 +57,8 @@ class Commands(BaseCommands):
         result = yield self.call(load(name), "plugins")
         yield Message(u"NOTICE", u"*", result.value)
 
-    def reload(self, sock, source, name):
-        user = User.objects.filter(sock=sock).first()
+    def reload(self, event, sock, source, name):
+        user = event.context.user
         if not user.oper:
             yield ERR_NOPRIVILEGES()
             return
@@ -66,8 +76,8 @@ class Commands(BaseCommands):
         result = yield self.call(load(name), "plugins")
         yield Message(u"NOTICE", u"*", result.value)
 
-    def unload(self, sock, source, name):
-        user = User.objects.filter(sock=sock).first()
+    def unload(self, event, sock, source, name):
+        user = event.context.user
         if not user.oper:
             yield ERR_NOPRIVILEGES()
             return
@@ -82,58 +92,114 @@ class Commands(BaseCommands):
         result = yield self.call(unload(name), "plugins")
         yield Message(u"NOTICE", u"*", result.value)
 
-    def die(self, sock, source):
-        user = User.objects.filter(sock=sock).first()
+    def die(self, event, sock, source):
+        user = event.context.user
         if not user.oper:
             return ERR_NOPRIVILEGES()
 
         raise SystemExit(0)
 
-    def restart(self, sock, source):
-        user = User.objects.filter(sock=sock).first()
+    def restart(self, event, sock, source):
+        user = event.context.user
         if not user.oper:
             yield ERR_NOPRIVILEGES()
             return
 
-        yield self.call(close(), "server")
+        if self.config["workers"] > 1:
+            yield Message(u"NOTICE", u"*", u"RESTART is not supported with several workers")
+            return
 
         args = sys.argv[:]
         self.parent.logger.info(u"Restarting... Args: {0}".format(args))
 
-        args.insert(0, sys.executable)
-        if sys.platform == 'win32':
-            args = ['"%s"' % arg for arg in args]
+        # Hand live state and connections over to the new process
+        store.flush()
+        store.stop()
 
+        filename = self.config["statefile"]
+        state = snapshot.capture(self.server)
+        snapshot.save(state, filename)
+        snapshot.inherit(state)
+
+        os.environ["CHARLA_RESUME"] = filename
+
+        args.insert(0, sys.executable)
         os.execv(sys.executable, args)
 
-    def kill(self, sock, source, target, reason=None):
-        user = User.objects.filter(sock=sock).first()
+    def stats(self, event, sock, source, query=u"m"):
+        user = event.context.user
+        if not user.oper:
+            return ERR_NOPRIVILEGES()
+
+        replies = []
+
+        if query == u"m":
+            for line in metrics.report():
+                replies.append(Message(u"NOTICE", u"*", line))
+        elif query == u"q":
+            transport = self.server.transport
+            for sock, queued in sorted(transport.queued.items(), key=itemgetter(1), reverse=True):
+                target = connections.get(sock)
+                nick = target.nick if target is not None else u"*"
+                replies.append(
+                    Message(
+                        u"NOTICE", u"*",
+                        u"SendQ {0}: {1}/{2}".format(nick, queued, transport.sendq)
+                    )
+                )
+
+        replies.append(RPL_ENDOFSTATS(query))
+
+        return replies
+
+    def kill(self, event, sock, source, target, reason=None):
+        user = event.context.user
         if not user.oper:
             return ERR_NOPRIVILEGES()
 
-        nick = User.objects.filter(nick=target).first()
+        nick = connections.find(target)
         if nick is None:
             return ERR_NOSUCHNICK(target)
 
         reason = u"Killed: {0}".format(reason) if reason else u"Killed"
 
-        self.fire(response.create("quit", nick.sock, nick.source, reason, disconnect=False))
-        self.fire(reply(nick.sock, ERROR(reason)), "server")
-        Timer(1, close(nick.sock), "server").register(self)
+        self.fire(response.create("quit", nick.sock, nick.source, reason, disconnect=False), "server")
+
+        # Users on other workers are disconnected by their own worker
+        if nick.local:
+            self.fire(reply(nick.sock, ERROR(reason)), "server")
+            timers.schedule(1, self.fire, close(nick.sock), "server")
+
+
+def normalize_mask(mask):
+    """Return mask with its host normalized if it is an address
+
+    Hosts of users are normalized (see :func:`charla.resolver.normalize`)
+    so masks of IPv4-mapped addresses must be too to match them.
+    """
+
+    prefix, sep, host = mask.rpartition(u"@")
+    try:
+        host = normalize(host).decode("ascii")
+    except SocketError:
+        pass
+    return prefix + sep + host
 
 
 class Admin(BasePlugin):
 
     olines = {
-        u"*!prologic@::ffff:127.0.0.1": (u"prologic", u"test"),
+        u"*!prologic@127.0.0.1": (u"prologic", u"test"),
     }
 
     def init(self, *args, **kwargs):
         super(Admin, self).init(*args, **kwargs)
 
+        self.masks = [(normalize_mask(k), v) for k, v in self.olines.items()]
+
         Commands(*args, **kwargs).register(self)
 
     def oline(self, user):
-        for k, v in self.olines.items():
+        for k, v in self.masks:
             if fnmatch(user.prefix, k):
                 return v
@@ -1,23 +1,31 @@
 import re
-from operator import attrgetter
 
 
-from circuits.protocols.irc import response, Message
+from circuits.protocols.irc import reply, response, Message
 from circuits.protocols.irc.replies import _M
 from circuits.protocols.irc.replies import RPL_NAMEREPLY, RPL_ENDOFNAMES, ERR_CHANOPRIVSNEEDED
 from circuits.protocols.irc.replies import MODE, JOIN, TOPIC, RPL_LIST, RPL_LISTEND, ERR_USERNOTINCHANNEL
 from circuits.protocols.irc.replies import RPL_NOTOPIC, RPL_TOPIC, ERR_NOSUCHCHANNEL, ERR_TOOMANYCHANNELS
 
-from funcy import imap, flatten
+from funcy import flatten
 
 
+from .core import NICKLEN
+
 from .. import models
+from ..store import store
 from ..plugin import BasePlugin
+from ..utils import casefold, compile_mask
 from ..commands import BaseCommands
 
 
 VALID_CHANNEL_REGEX = re.compile(r"^[&#+!][^\x00\x07\x0a\x0d ,:]*$")
 
+WILDCARDS = re.compile(r"[*?]")
+
+# Number of channels LIST examines before yielding to the event loop
+LISTBATCH = 100
+
 
 def KICK(channel, nick, reason=None, prefix=None):
     return _M(u"KICK", channel, nick, reason or nick, prefix=prefix)
@@ -25,8 +33,8 @@ def KICK(channel, nick, reason=None, prefix=None):
 
 class Commands(BaseCommands):
 
-    def _join(self, sock, source, name):
-        user = models.User.objects.filter(sock=sock).first()
+    def _join(self, event, sock, source, name):
+        user = event.context.user
 
         if name and name[0] not in self.parent.chantypes:
             return ERR_NOSUCHCHANNEL(name)
@@ -37,89 +45,88 @@ class Commands(BaseCommands):
         if len(name) > self.parent.channellen:
             return ERR_NOSUCHCHANNEL(name)
 
-        replies = [JOIN(name, prefix=user.prefix)]
-
-        channel = models.Channel.objects.filter(name=name).first()
-        if channel is None:
-            channel = models.Channel(name=name)
-            channel.save()
-
-        if user in channel.users:
-            return
+        channel = models.channels.get(name)
+        if channel is not None:
+            if user in channel.members:
+                return
+            name = channel.name
 
         type = name[0]
-        nchannels = len([x for x in user.channels if channel.type == type])
-        if nchannels >= self.parent.chanlimit[type]:
-            return ERR_TOOMANYCHANNELS(name)
+        chanlimit = self.parent.chanlimit.get(type)
+        if chanlimit is not None:
+            nchannels = len([x for x in user.channels if x.type == type])
+            if nchannels >= chanlimit:
+                return ERR_TOOMANYCHANNELS(name)
+
+        if channel is None:
+            channel = models.Channel(name)
 
         self.notify(
-            channel.users[:],
+            channel.users,
             JOIN(name, prefix=user.prefix)
         )
 
-        user.channels.append(channel)
-        user.save()
+        replies = [JOIN(name, prefix=user.prefix)]
 
-        if not channel.users:
+        if self.parent.founders and user.local:
+            # Another worker may be creating the same channel
+            op = not channel.members and store.found(channel, user)
+        elif self.parent.founders and user.sock.worker is not None:
+            # Replayed from the worker that decided, see Store.found
+            operators = any(member.operator for member in channel.members.values())
+            op = not operators and store.founder(channel) == user.id
+        else:
+            op = not channel.members
+
+        if op:
             replies.append(MODE(name, u"+o {0}".format(user.nick), prefix=self.server.host))
-            channel.operators.append(user)
-            channel.save()
-
-        channel.users.append(user)
-        channel.save()
+            channel.join(user, u"o")
+        else:
+            channel.join(user)
 
         self.fire(response.create("topic", sock, source, channel.name), "server")
         self.fire(response.create("names", sock, source, channel.name), "server")
 
         return replies
 
-    def join(self, sock, source, names):
-        return flatten(self._join(sock, source, name) for name in names.split(u","))
+    def join(self, event, sock, source, names):
+        return flatten(self._join(event, sock, source, name) for name in names.split(u","))
 
-    def part(self, sock, source, name, reason=u"Leaving"):
-        user = models.User.objects.filter(sock=sock).first()
+    def part(self, event, sock, source, name, reason=u"Leaving"):
+        user = event.context.user
 
-        channel = models.Channel.objects.filter(name=name).first()
+        channel = models.channels.get(name)
 
         if channel is None:
             return
 
-        if user not in channel.users:
+        if user not in channel.members:
             return
 
         self.notify(
             channel.users,
-            Message(u"PART", name, reason, prefix=user.prefix)
+            Message(u"PART", channel.name, reason, prefix=user.prefix)
         )
 
-        user.channels.remove(channel)
-        user.save()
-
-        channel.users.remove(user)
-        if user in channel.operators:
-            channel.operators.remove(user)
-        if user in channel.voiced:
-            channel.voiced.remove(user)
-        channel.save()
-
-        if not channel.users:
-            channel.delete()
+        channel.part(user)
 
     def names(self, sock, source, name):
-        channel = models.Channel.objects.filter(name=name).first()
+        channel = models.channels.get(name)
 
         if channel is None:
             return ERR_NOSUCHCHANNEL(name)
 
-        return [
-            RPL_NAMEREPLY(channel.name, channel.userprefixes),
-            RPL_ENDOFNAMES(name),
-        ]
+        width = self.parent.namelen - len(channel.name.encode("utf-8"))
 
-    def topic(self, sock, source, name, topic=None):
-        user = models.User.objects.filter(sock=sock).first()
+        replies = [RPL_NAMEREPLY(channel.name, chunk) for chunk in channel.namereply(width)]
+        replies.append(RPL_ENDOFNAMES(channel.name))
 
-        channel = models.Channel.objects.filter(name=name).first()
+        return replies
+
+    def topic(self, event, sock, source, name, topic=None):
+        user = event.context.user
+
+        channel = models.channels.get(name)
         if channel is None:
             return ERR_NOSUCHCHANNEL(name)
 
@@ -129,57 +136,84 @@ class Commands(BaseCommands):
         if topic is None:
             return RPL_TOPIC(channel.name, channel.topic)
 
-        if not user.oper and u"t" in channel.modes and user not in channel.operators:
+        if not user.oper and channel.flags & channel.TOPICLOCK and not channel.is_operator(user):
             return ERR_CHANOPRIVSNEEDED(channel.name)
 
         channel.topic = topic
         channel.save()
 
-        self.notify(channel.users[:], TOPIC(channel.name, topic, prefix=user.prefix))
-
-    def list(self, sock, source):
-        replies = []
-
-        for channel in models.Channel.objects.all():
-            nvisible = len([x for x in channel.users if x.visible])
-            replies.append(RPL_LIST(channel.name, nvisible, channel.topic))
-
-        replies.append(RPL_LISTEND)
-
-        return replies
-
-    def kick(self, sock, source, name, nick, reason=None):
-        user = models.User.objects.filter(sock=sock).first()
-
-        channel = models.Channel.objects.filter(name=name).first()
+        self.notify(channel.users, TOPIC(channel.name, topic, prefix=user.prefix))
+
+    def list(self, event, sock, source, *args):
+        """LIST command
+
+        Streams the channel directory to the client a batch at a time.
+        Supports the ELIST filters M (``#foo*`` name masks), N (``!mask``
+        negated masks) and U (``>n`` / ``<n`` visible user counts) given
+        as comma separated parameters.
+        """
+
+        masks, nmasks = [], []
+        minusers = maxusers = None
+
+        for param in (args[0].split(u",") if args else ()):
+            if param[:1] == u">" and param[1:].isdigit():
+                minusers = int(param[1:])
+            elif param[:1] == u"<" and param[1:].isdigit():
+                maxusers = int(param[1:])
+            elif param[:1] == u"!":
+                nmasks.append(compile_mask(param[1:]))
+            elif param:
+                masks.append(param)
+
+        # A single mask narrows the search to its literal prefix
+        prefix = WILDCARDS.split(masks[0], 1)[0] if len(masks) == 1 else u""
+        masks = [compile_mask(mask) for mask in masks]
+
+        for i, channel in enumerate(models.channels.search(prefix), 1):
+            if not i % LISTBATCH:
+                # Let the event loop run between batches
+                yield
+
+            nvisible = channel.nvisible
+            if minusers is not None and nvisible <= minusers:
+                continue
+            if maxusers is not None and nvisible >= maxusers:
+                continue
+
+            key = casefold(channel.name)
+            if masks and not any(mask.match(key) for mask in masks):
+                continue
+            if any(mask.match(key) for mask in nmasks):
+                continue
+
+            self.fire(
+                reply(sock, RPL_LIST(channel.name, nvisible, channel.topic), event.context),
+                self.server.channel
+            )
+
+        yield RPL_LISTEND()
+
+    def kick(self, event, sock, source, name, nick, reason=None):
+        user = event.context.user
+
+        channel = models.channels.get(name)
         if channel is None:
             return ERR_NOSUCHCHANNEL(name)
 
-        if not user.oper and user not in channel.operators:
+        if not user.oper and not channel.is_operator(user):
             return ERR_CHANOPRIVSNEEDED(channel.name)
 
-        if nick not in imap(attrgetter("nick"), channel.users):
+        target = models.connections.find(nick)
+        if target is None or target not in channel.members:
             return ERR_USERNOTINCHANNEL(nick, channel.name)
 
-        nick = models.User.objects.filter(nick=nick).first()
-
         self.notify(
-            channel.users[:],
-            Message(u"KICK", channel.name, nick.nick, reason or nick.nick, prefix=user.prefix)
+            channel.users,
+            Message(u"KICK", channel.name, target.nick, reason or target.nick, prefix=user.prefix)
         )
 
-        nick.channels.remove(channel)
-        nick.save()
-
-        channel.users.remove(nick)
-        if user in channel.operators:
-            channel.operators.remove(user)
-        if user in channel.voiced:
-            channel.voiced.remove(user)
-        channel.save()
-
-        if not channel.users:
-            channel.delete()
+        channel.part(target)
 
 
 class Channel(BasePlugin):
@@ -195,7 +229,16 @@ class Channel(BasePlugin):
             u"#": 120,
         }
 
+        # Channel creation must be decided in Redis when other workers
+        # share channels
+        self.founders = self.config["workers"] > 1
+
+        # Bytes available for nicks in a RPL_NAMEREPLY line excluding the
+        # channel name: ":<host> 353 <nick> = <channel> :<names>\r\n"
+        self.namelen = 512 - len(u":{0} 353  =  :\r\n".format(self.server.host)) - NICKLEN
+
         self.features = (
+            u"ELIST=MNU",
             u"PREFIX=(ov)@+",
             u"CHANTYPES={0}".format(self.chantypes),
             u"TOPICLEN={0}".format(self.topiclen),
@@ -1,20 +1,25 @@
-from socket import getaddrinfo, gethostbyaddr, AF_INET6
+from time import time
 
 
-from circuits import handler, task
+from circuits import handler, Event, Timer
+from circuits.net.events import write
+from circuits.net.sockets import UDPClient, UDP6Client
 from circuits.protocols.irc import reply, Message
 
 
 from ..events import signon
+from ..metrics import metrics
 from ..plugin import BasePlugin
-from ..models import User, UserInfo
+from ..models import connections
+from ..resolver import nameserver, normalize, Resolver
 
 
-def check_host(sock):
-    host = sock.getpeername()[0]
-    if ":" in host:
-        return getaddrinfo(host, None, AF_INET6)[0][-1][0]
-    return gethostbyaddr(host)[0]
+class expire(Event):
+    """expire Event"""
+
+
+class resolved(Event):
+    """resolved Event"""
 
 
 class CheckHost(BasePlugin):
@@ -22,41 +27,83 @@ class CheckHost(BasePlugin):
     def init(self, *args, **kwargs):
         super(CheckHost, self).init(*args, **kwargs)
 
+        # sock -> (deadline, address) of connections awaiting a hostname
         self.pending = {}
 
-    def task_complete(self, e, value):
-        _, sock = e.args
-        del self.pending[sock]
+        # Connections whose signon is held up until their lookup is done
+        self.deferred = set()
+
+        # Seconds registration may be held up by a lookup
+        self.deadline = self.config["lookupdeadline"]
+
+        host = self.config.get("nameserver") or nameserver()
+        self.nameserver = (host, 53)
+
+        if ":" in host:
+            UDP6Client(("::", 0), channel="resolver").register(self)
+        else:
+            UDPClient(("0.0.0.0", 0), channel="resolver").register(self)
+
+        self.resolver = Resolver(self.send)
+
+        Timer(1, expire(), self.channel, persist=True).register(self)
+
+    def send(self, data):
+        self.fire(write(self.nameserver, data), "resolver")
+
+    @handler("read", channel="resolver")
+    def _on_resolver_read(self, address, data):
+        if address[:2] == self.nameserver:
+            self.resolver.receive(data)
+
+    def expire(self):
+        self.resolver.expire()
+
+        # Give up on lookups past the deadline, late results are ignored
+        now = time()
+        for sock, (deadline, address) in list(self.pending.items()):
+            if deadline <= now:
+                metrics.incr("resolver.deadline")
+                self.fire(resolved(sock, address, None))
 
-        self.fire(reply(sock, Message(u"NOTICE", u"*", u"*** Found your hostname")))
+    def resolved(self, sock, address, hostname):
+        if self.pending.pop(sock, None) is None:
+            return
 
-        user = User.objects.filter(sock=sock).first()
+        user = connections.get(sock)
+        if user is None:
+            return
 
-        if user.userinfo is None:
-            userinfo = UserInfo()
-            userinfo.save()
+        if hostname is None:
+            notice = u"*** Couldn't look up your hostname"
+            hostname = normalize(address)
+        else:
+            notice = u"*** Found your hostname"
 
-            user.userinfo = userinfo
-            user.save()
+        self.fire(reply(sock, Message(u"NOTICE", u"*", notice)))
 
-        user.userinfo.host = value
-        user.userinfo.save()
+        user.hostname = hostname
+        user.save()
 
-        if user.registered:
-            return signon(sock, user.source)
+        if sock in self.deferred:
+            self.deferred.discard(sock)
+            self.fire(signon(sock, user.source))
 
     def connect(self, sock, *args):
         host, port = args[:2]
-        self.pending[sock] = True
+        self.pending[sock] = (time() + self.deadline, host)
         self.fire(reply(sock, Message(u"NOTICE", u"*", u"*** Looking up your hostname...")))
 
-        e = task(check_host, sock)
-        e.complete = True
-        e.complete_channels = ("server",)
+        self.resolver.lookup(
+            host, lambda hostname: self.fire(resolved(sock, host, hostname))
+        )
 
-        self.fire(e, "threadpool")
+    def disconnect(self, sock):
+        self.pending.pop(sock, None)
+        self.deferred.discard(sock)
 
     @handler("signon", priority=1.0)
     def signon(self, event, sock, source):
-        if self.pending.get(sock, False):
+        if sock in self.pending:
             event.stop()
+            self.deferred.add(sock)
@@ -1,41 +1,43 @@
 import re
-from itertools import chain
-from operator import attrgetter
 
 
 from circuits.protocols.irc import joinprefix, Message
 from circuits.protocols.irc.replies import ERR_ERRONEUSNICKNAME, ERR_NICKNAMEINUSE
 
 
+from ..store import store
 from ..events import signon
+from ..utils import casefold, CASEMAPPING
 from ..plugin import BasePlugin
-from ..models import User, UserInfo
+from ..models import connections
 from ..commands import BaseCommands
 
 
+NICKLEN = 16
+
 VALID_NICK_REGEX = re.compile(r"^[][\`_^{|}A-Za-z][][\`_^{|}A-Za-z0-9-]*$")
 
 
 class Commands(BaseCommands):
 
-    def quit(self, sock, source, reason=u"Leaving", **kwargs):
-        user = User.objects.filter(sock=sock).first()
+    def quit(self, event, sock, source, reason=u"Leaving", **kwargs):
+        user = event.context.user
 
-        for channel in user.channels:
-            channel.users.remove(user)
+        users = user.peers
 
-            if not channel.users:
-                channel.delete()
+        user.quit()
 
-        users = chain(*map(attrgetter("users"), user.channels))
+        if user.local:
+            if user.nick is not None and self.parent.claims:
+                store.release(user.nick, user)
 
-        if kwargs.get("disconnect", True):
-            self.disconnect(user)
+            if kwargs.get("disconnect", True):
+                self.disconnect(user)
 
         self.notify(users, Message(u"QUIT", reason, prefix=user.prefix), user)
 
-    def nick(self, sock, source, nick):
-        user = User.objects.filter(sock=sock).first()
+    def nick(self, event, sock, source, nick):
+        user = event.context.user
 
         if not VALID_NICK_REGEX.match(nick):
             return ERR_ERRONEUSNICKNAME(nick)
@@ -43,38 +45,52 @@ class Commands(BaseCommands):
         if len(nick) > self.parent.nicklen:
             return ERR_ERRONEUSNICKNAME(nick)
 
-        if any(x for x in User.objects.all() if x.nick and x.nick.lower() == nick.lower()):
-            return ERR_NICKNAMEINUSE(nick)
+        if nick == user.nick:
+            return
+
+        # The worker a remote user is connected to has already checked
+        if user.local:
+            other = connections.find(nick)
+            if other is not None and other is not user:
+                return ERR_NICKNAMEINUSE(nick)
+
+            if self.parent.claims:
+                if not store.claim(nick, user):
+                    return ERR_NICKNAMEINUSE(nick)
+                if user.nick is not None and casefold(user.nick) != casefold(nick):
+                    store.release(user.nick, user)
 
         prefix = user.prefix or joinprefix(*source)
         user.nick = nick
         user.save()
 
-        if not user.registered and user.userinfo is not None:
+        if not user.registered and user.username is not None:
             user.registered = True
             user.save()
             return signon(sock, user.source)
 
-        users = chain(*map(attrgetter("users"), user.channels))
+        # Clients are only told of nick changes once registered
+        if not user.registered:
+            return
+
+        for channel in user.channels:
+            channel.invalidate()
+
+        users = user.peers
+        users.add(user)
 
         self.notify(users, Message(u"NICK", nick, prefix=prefix))
 
-    def user(self, sock, source, username, hostname, server, realname):
-        _user = User.objects.filter(sock=sock).first()
+    def user(self, event, sock, source, username, hostname, server, realname):
+        _user = event.context.user
 
-        if _user.userinfo is None:
-            userinfo = UserInfo(
-                user=username, host=hostname, name=realname, server=server
-            )
-        else:
-            userinfo = _user.userinfo
-            userinfo.user = username
-            userinfo.name = realname
-            userinfo.server = server
+        if _user.hostname is None:
+            _user.hostname = hostname
 
-        userinfo.save()
+        _user.username = username
+        _user.realname = realname
+        _user.server = server
 
-        _user.userinfo = userinfo
         _user.save()
 
         if not _user.registered and _user.nick:
@@ -88,10 +104,14 @@ class Core(BasePlugin):
     def init(self, *args, **kwargs):
         super(Core, self).init(*args, **kwargs)
 
-        self.nicklen = 16
+        self.nicklen = NICKLEN
+
+        # Nicks must be claimed in Redis when other workers share them
+        self.claims = self.config["workers"] > 1
 
         self.features = (
             "NICKLEN={0}".format(self.nicklen),
+            "CASEMAPPING={0}".format(CASEMAPPING),
         )
 
         Commands(*args, **kwargs).register(self)
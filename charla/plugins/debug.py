@@ -1,4 +1,4 @@
-from ..models import User
+from ..models import connections
 from ..plugin import BasePlugin
 
 
@@ -12,14 +12,14 @@ class Debug(BasePlugin):
         self.logger.info(u"C: [{0:s}:{1:d}]".format(host, port))
 
     def disconnect(self, sock):
-        user = User.objects.filter(sock=sock).first()
+        user = connections.get(sock)
         if user is None:
             return
 
         self.logger.info(u"D: [{0:s}:{1:d}]".format(user.host, user.port))
 
     def read(self, sock, data):
-        user = User.objects.filter(sock=sock).first()
+        user = connections.get(sock)
 
         if user is not None:
             host, port = user.host, user.port
@@ -29,7 +29,7 @@ class Debug(BasePlugin):
         self.logger.info(u"I: [{0:s}:{1:d}] {2:s}".format(host, port, repr(data)))
 
     def write(self, sock, data):
-        user = User.objects.filter(sock=sock).first()
+        user = connections.get(sock)
         if user is None:
             return
 
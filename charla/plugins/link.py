@@ -0,0 +1,777 @@
+"""Link Plugin
+
+Links this server with others so that together they form one network.
+
+Servers are linked in a tree over TCP (``--linkport`` and ``--link``)
+and exchange newline delimited JSON messages. After a handshake
+(``server``) proving both sides know the link password
+(``--linkpassword``, without which no links are made) each side bursts
+its state: the servers behind it (``sid``), its users (``user``) and
+the channels they are in (``channel``). From then on the same messages
+the worker bus uses (see :mod:`charla.bus`) are propagated: user
+updates and the commands of local users (``cmd``, only those of
+:data:`charla.bus.COMMANDS`) which every server runs against its own
+copy of the network, delivering to its own clients only. Every message
+is passed on to all other links.
+
+The link password is sent in cleartext, so links must only be made
+over trusted networks or tunnels.
+
+Users are known across the network by a ``uid`` of their server's
+name and their id there. Nick collisions are resolved by nick change
+timestamp: the user who took the nick last loses and is killed, or
+both are on a tie. Channels created at different times keep the modes
+and topic of the older one when merged, local members being sent the
+MODE and TOPIC changes this makes.
+
+When a link is lost or removed with SQUIT every server behind it is
+dropped and its users quit with the names of the two servers the split
+occurred between.
+"""
+
+
+import hmac
+import json
+from time import time
+from fnmatch import fnmatch
+from calendar import timegm
+from datetime import datetime
+from operator import attrgetter
+
+
+from circuits import handler, Component, Event, Timer
+from circuits.net.events import close, connect, write
+from circuits.net.sockets import TCPServer, TCPClient
+from circuits.protocols.irc import reply, response, Message
+from circuits.protocols.irc.replies import _M, ERROR, ERR_NOPRIVILEGES
+
+
+from ..store import store
+from ..wheel import timers
+from ..utils import casefold
+from ..events import broadcast
+from ..plugin import BasePlugin
+from ..bus import apply, remove, COMMANDS, FIELDS
+from ..commands import BaseCommands
+from ..models import channels, connections, servers, Channel, Peer, Remote, User
+from .mode import format_modes, MAXMODES
+
+
+# Seconds between attempts to connect configured links that are down
+RECONNECT = 30
+
+# Most bytes a link may send without a newline
+MAXLINE = 1 << 20
+
+
+def compare_digest(a, b):
+    """Compare a and b in time independent of where they differ
+
+    :func:`hmac.compare_digest` is only available from Python 2.7.7.
+    """
+
+    if hasattr(hmac, "compare_digest"):
+        return hmac.compare_digest(a, b)
+
+    if len(a) != len(b):
+        return False
+
+    result = 0
+    for x, y in zip(bytearray(a), bytearray(b)):
+        result |= x ^ y
+    return result == 0
+
+
+def RPL_LINKS(name, uplink, hops, info):
+    return _M(u"364", name, uplink, u"{0} {1}".format(hops, info))
+
+
+def RPL_ENDOFLINKS(mask):
+    return _M(u"365", mask, u"End of /LINKS list")
+
+
+def RPL_MAP(line):
+    return _M(u"015", line)
+
+
+def RPL_MAPEND():
+    return _M(u"017", u"End of /MAP")
+
+
+def ERR_NOSUCHSERVER(name):
+    return _M(u"402", name, u"No such server")
+
+
+def timestamp(value):
+    return timegm(value.utctimetuple())
+
+
+class reconnect(Event):
+    """reconnect Event"""
+
+
+class Session(object):
+    """A connection to a directly linked server
+
+    ``name`` is ``None`` until the other server has identified itself.
+    """
+
+    __slots__ = ("name", "send", "close", "buffer", "outbound",)
+
+    def __init__(self, send, close, outbound):
+        self.name = None
+        self.send = send
+        self.close = close
+        self.buffer = b""
+        self.outbound = outbound
+
+
+class Connector(Component):
+    """Outgoing link to a configured server, retried while it is down"""
+
+    def init(self, link, host, port):
+        self.link = link
+        self.host = host
+        self.port = port
+
+        self.client = TCPClient(channel=self.channel).register(self)
+
+        Timer(RECONNECT, reconnect(), self.channel, persist=True).register(self)
+
+    def ready(self, component):
+        if component is self.client:
+            self.reconnect()
+
+    def reconnect(self):
+        if not self.client.connected:
+            self.fire(connect(self.host, self.port))
+
+    def connected(self, host, port):
+        self.link.opened(
+            self, lambda data: self.fire(write(data)), lambda: self.fire(close()), True
+        )
+
+    def read(self, data):
+        self.link.received(self, data)
+
+    def disconnected(self):
+        self.link.closed(self)
+
+
+class Commands(BaseCommands):
+
+    def links(self, sock, source, *args):
+        mask = args[-1] if args else u"*"
+
+        host = self.server.host
+        entries = [(host, host, 0, self.server.info)] + [
+            (peer.name, peer.uplink, peer.hops, peer.info)
+            for peer in sorted(servers, key=attrgetter("hops", "name"))
+        ]
+
+        replies = [
+            RPL_LINKS(name, uplink, hops, info)
+            for name, uplink, hops, info in entries
+            if fnmatch(casefold(name), casefold(mask))
+        ]
+        replies.append(RPL_ENDOFLINKS(mask))
+
+        return replies
+
+    def map(self, sock, source):
+        host = self.server.host
+
+        nusers = {}
+        for user in connections:
+            if user.registered:
+                name = casefold(user.origin or host)
+                nusers[name] = nusers.get(name, 0) + 1
+
+        children = {}
+        for peer in sorted(servers, key=attrgetter("name")):
+            children.setdefault(casefold(peer.uplink), []).append(peer.name)
+
+        replies = []
+
+        def walk(name, depth):
+            indent = u"  " * (depth - 1) + u"`- " if depth else u""
+            n = nusers.get(casefold(name), 0)
+            replies.append(RPL_MAP(u"{0}{1} ({2} users)".format(indent, name, n)))
+            for child in children.get(casefold(name), ()):
+                walk(child, depth + 1)
+
+        walk(host, 0)
+        replies.append(RPL_MAPEND())
+
+        return replies
+
+    def squit(self, event, sock, source, server, reason=u"SQUIT"):
+        user = event.context.user
+        if not user.oper:
+            return ERR_NOPRIVILEGES()
+
+        if not self.parent.squit(server, reason):
+            return ERR_NOSUCHSERVER(server)
+
+
+class Link(BasePlugin):
+
+    def init(self, *args, **kwargs):
+        super(Link, self).init(*args, **kwargs)
+
+        Commands(*args, **kwargs).register(self)
+
+        self.password = self.config.get("linkpassword")
+        if isinstance(self.password, bytes):
+            self.password = self.password.decode("utf-8")
+
+        # key -> Session where key is a socket or Connector
+        self.sessions = {}
+
+        # uid -> User and User -> uid of users on other servers
+        self.uids = {}
+        self.ids = {}
+
+        # User -> time of the user's last nick change
+        self.ts = {}
+
+        # Local users announced to the network
+        self.introduced = set()
+
+        # Messages to send to every link at the end of this tick
+        self.outbox = []
+
+        links = self.config.get("links") or ()
+        port = self.config.get("linkport")
+
+        self.active = bool(links or port)
+        if self.active and self.config["workers"] > 1:
+            self.logger.error("Linking is not supported with several workers")
+            self.active = False
+        elif self.active and not self.password:
+            self.logger.error("Linking requires a link password (--linkpassword)")
+            self.active = False
+
+        if not self.active:
+            return
+
+        if port:
+            TCPServer(("0.0.0.0", port), channel="links").register(self)
+
+        for link in links:
+            host, port = link.rsplit(":", 1)
+            Connector(self, host, int(port), channel="link:{0}".format(link)).register(self)
+
+    @handler("connect", channel="links")
+    def _on_links_connect(self, sock, *args):
+        self.opened(
+            sock,
+            lambda data: self.fire(write(sock, data), "links"),
+            lambda: self.fire(close(sock), "links"),
+            False
+        )
+
+    @handler("read", channel="links")
+    def _on_links_read(self, sock, data):
+        self.received(sock, data)
+
+    @handler("disconnect", channel="links")
+    def _on_links_disconnect(self, sock):
+        self.closed(sock)
+
+    @handler("relay", channel="bus")
+    def _on_relay(self, user, command, args):
+        if self.established():
+            # A nick change earlier in this tick must arrive first
+            self.update(user)
+            self.outbox.append({u"t": u"cmd", u"uid": self.uid(user), u"c": command, u"a": args})
+
+        if command == "quit":
+            self.introduced.discard(user)
+            self.ts.pop(user, None)
+
+    @handler("generate_events", channel="*", priority=1.0)
+    def _on_generate_events(self, event):
+        """Send the messages of this tick before the store is flushed"""
+
+        if not self.active or not self.established():
+            return
+
+        for model in store.dirty:
+            if isinstance(model, User) and model.registered and model.local:
+                self.update(model)
+
+        if self.outbox:
+            for message in self.outbox:
+                self.forward(None, message)
+            self.outbox = []
+
+    @handler(False)
+    def established(self):
+        return any(session.name is not None for session in self.sessions.values())
+
+    @handler(False)
+    def uid(self, user):
+        uid = self.ids.get(user)
+        if uid is None:
+            uid = u"{0}/{1}".format(self.server.host, user.id)
+        return uid
+
+    @handler(False)
+    def find(self, uid):
+        user = self.uids.get(uid)
+        if user is not None:
+            return user
+
+        host, _, id = uid.rpartition(u"/")
+        if casefold(host) == casefold(self.server.host) and id.isdigit():
+            return connections.ids.get(int(id))
+
+    @handler(False)
+    def nickts(self, user):
+        ts = self.ts.get(user)
+        if ts is None:
+            ts = timestamp(user.signon)
+        return ts
+
+    @handler(False)
+    def routed(self, user, session):
+        """Return ``True`` if user is reached through session"""
+
+        if user.origin is None:
+            return False
+
+        peer = servers.get(user.origin)
+        return peer is not None and casefold(peer.via) == casefold(session.name)
+
+    @handler(False)
+    def intro(self, user):
+        message = dict((field, getattr(user, field)) for field in FIELDS)
+        message.update({
+            u"t": u"user", u"uid": self.uid(user), u"ts": self.nickts(user),
+            u"origin": user.origin or self.server.host,
+        })
+        return message
+
+    @handler(False)
+    def update(self, user):
+        """Queue the shared fields of local user changed since the last flush"""
+
+        if user not in self.introduced:
+            self.introduced.add(user)
+            self.outbox.append(self.intro(user))
+            return
+
+        if not user.dirty:
+            return
+
+        fields = dict(
+            (field, value) for field, value in user.dirty.items() if field in FIELDS
+        )
+        if not fields:
+            return
+
+        if u"nick" in fields:
+            self.ts[user] = fields[u"ts"] = int(time())
+
+        fields.update({u"t": u"user", u"uid": self.uid(user)})
+        self.outbox.append(fields)
+
+    @handler(False)
+    def send(self, session, message):
+        session.send(json.dumps(message) + "\n")
+
+    @handler(False)
+    def forward(self, origin, message):
+        """Send message to every established link but origin"""
+
+        data = json.dumps(message) + "\n"
+        for session in self.sessions.values():
+            if session.name is not None and session is not origin:
+                session.send(data)
+
+    @handler(False)
+    def opened(self, key, send, close, outbound):
+        session = self.sessions[key] = Session(send, close, outbound)
+        if outbound:
+            self.send(session, self.hello())
+
+    @handler(False)
+    def closed(self, key):
+        session = self.sessions.pop(key, None)
+        if session is None or session.name is None:
+            return
+
+        self.logger.info(u"Link to {0} closed".format(session.name))
+
+        peer = servers.get(session.name)
+        if peer is not None:
+            self.split(peer, session)
+
+    @handler(False)
+    def received(self, key, data):
+        session = self.sessions.get(key)
+        if session is None:
+            return
+
+        lines = (session.buffer + data).split(b"\n")
+        session.buffer = lines.pop()
+
+        if len(session.buffer) > MAXLINE:
+            return self.drop(session, u"Line too long")
+
+        for line in lines:
+            if not line.strip():
+                continue
+
+            try:
+                message = json.loads(line)
+                kind = message["t"]
+            except (ValueError, KeyError, TypeError):
+                return self.drop(session, u"Protocol error")
+
+            if session.name is None and kind not in (u"server", u"error"):
+                return self.drop(session, u"Not registered")
+
+            f = getattr(self, "_on_{0}".format(kind), None)
+            if f is None:
+                self.logger.warn(u"Unknown link message: {0}".format(message))
+                continue
+
+            f(session, message)
+
+            # The session may have been dropped by the message
+            if key not in self.sessions:
+                return
+
+    @handler(False)
+    def drop(self, session, reason):
+        """Close a link telling the other side why"""
+
+        self.send(session, {u"t": u"error", u"reason": reason})
+        session.close()
+
+    @handler(False)
+    def hello(self):
+        return {
+            u"t": u"server", u"name": self.server.host, u"info": self.server.info,
+            u"password": self.password,
+        }
+
+    @handler(False)
+    def burst(self, session):
+        """Send the state of the network on our side of session"""
+
+        for peer in sorted(servers, key=attrgetter("hops")):
+            if casefold(peer.via) != casefold(session.name):
+                self.send(session, {
+                    u"t": u"sid", u"name": peer.name, u"info": peer.info,
+                    u"hops": peer.hops, u"uplink": peer.uplink,
+                })
+
+        for user in connections:
+            if user.registered and not self.routed(user, session):
+                if user.local:
+                    self.introduced.add(user)
+                self.send(session, self.intro(user))
+
+        for channel in channels:
+            members = [
+                [self.uid(user), member.modes]
+                for user, member in channel.members.items()
+                if not self.routed(user, session)
+            ]
+            if members:
+                self.send(session, {
+                    u"t": u"channel", u"name": channel.name,
+                    u"ts": timestamp(channel.created), u"flags": channel.flags,
+                    u"topic": channel.topic, u"members": members,
+                })
+
+    @handler(False)
+    def split(self, peer, origin):
+        """Drop peer and every server behind it"""
+
+        lost = set([casefold(peer.name)])
+        while True:
+            behind = set(
+                casefold(other.name) for other in servers
+                if casefold(other.uplink) in lost
+            )
+            if behind <= lost:
+                break
+            lost |= behind
+
+        for name in lost:
+            servers.remove(servers.get(name))
+
+        reason = u"{0} {1}".format(peer.uplink, peer.name)
+        for user in list(self.ids):
+            if casefold(user.origin) in lost:
+                self.vanish(user, reason)
+
+        self.logger.info(u"Netsplit {0}, lost {1} server(s)".format(reason, len(lost)))
+
+        self.forward(origin, {u"t": u"squit", u"name": peer.name, u"reason": reason})
+
+    @handler(False)
+    def squit(self, name, reason):
+        """Close the direct link to server name
+
+        Returns ``False`` if no server of that name is directly linked.
+        """
+
+        for session in self.sessions.values():
+            if session.name is not None and casefold(session.name) == casefold(name):
+                self.drop(session, reason)
+                return True
+
+        return False
+
+    @handler(False)
+    def forget(self, user):
+        uid = self.ids.pop(user, None)
+        self.uids.pop(uid, None)
+        self.ts.pop(user, None)
+
+    @handler(False)
+    def vanish(self, user, reason):
+        """Remove a user on another server with a QUIT to local peers"""
+
+        self.forget(user)
+
+        if user.sock in connections:
+            self.fire(remove(user, reason), "server")
+
+    @handler(False)
+    def kill(self, user, reason):
+        """Kill user across the network"""
+
+        self.forward(None, {u"t": u"kill", u"uid": self.uid(user), u"reason": reason})
+        self.expel(user, reason)
+
+    @handler(False)
+    def expel(self, user, reason):
+        """Remove a killed user from this server"""
+
+        if not user.local:
+            self.vanish(user, reason)
+            return
+
+        self.fire(response.create("quit", user.sock, user.source, reason, disconnect=False), "server")
+        self.fire(reply(user.sock, ERROR(reason)), "server")
+        timers.schedule(1, self.fire, close(user.sock), "server")
+
+    @handler(False)
+    def collide(self, uid, nick, ts):
+        """Resolve a clash over nick with the user uid introduced or renamed
+
+        The user who took nick last is killed, both are on a tie.
+        Returns ``False`` if uid may not have nick.
+        """
+
+        other = connections.find(nick)
+        if other is None or self.ids.get(other) == uid:
+            return True
+
+        mine = self.nickts(other)
+
+        if ts <= mine:
+            self.kill(other, u"Nick collision")
+
+        if ts >= mine:
+            user = self.uids.get(uid)
+            if user is not None:
+                self.kill(user, u"Nick collision")
+            else:
+                self.forward(None, {u"t": u"kill", u"uid": uid, u"reason": u"Nick collision"})
+            return False
+
+        return True
+
+    @handler(False)
+    def announce(self, channel, changes, topic):
+        """Tell the local members of channel how a merge changed it"""
+
+        local = [user for user in channel.members if user.local]
+        if not local:
+            return
+
+        for i in range(0, len(changes), MAXMODES):
+            modes, params = format_modes(changes[i:i + MAXMODES])
+            message = Message(u"MODE", channel.name, modes, *params)
+            self.fire(broadcast(local, message), "server")
+
+        if topic:
+            message = Message(u"TOPIC", channel.name, channel.topic or u"")
+            self.fire(broadcast(local, message), "server")
+
+    @handler(False)
+    def _on_error(self, session, message):
+        self.logger.warn(u"Link to {0} closed by peer: {1}".format(
+            session.name or u"*", message.get("reason"))
+        )
+
+    @handler(False)
+    def _on_server(self, session, message):
+        if session.name is not None:
+            return
+
+        password = message.get("password")
+        if not self.password or not isinstance(password, unicode):
+            return self.drop(session, u"Bad password")
+        if not compare_digest(password.encode("utf-8"), self.password.encode("utf-8")):
+            return self.drop(session, u"Bad password")
+
+        name = message["name"]
+        if casefold(name) == casefold(self.server.host) or name in servers:
+            return self.drop(session, u"Server exists")
+
+        if not session.outbound:
+            self.send(session, self.hello())
+
+        session.name = name
+        info = message.get("info") or u""
+        servers.update(Peer(name, info, 1, self.server.host, name))
+
+        self.logger.info(u"Linked to {0}".format(name))
+
+        self.burst(session)
+
+        self.forward(session, {
+            u"t": u"sid", u"name": name, u"info": info, u"hops": 1,
+            u"uplink": self.server.host,
+        })
+
+    @handler(False)
+    def _on_sid(self, session, message):
+        name = message["name"]
+        if casefold(name) == casefold(self.server.host) or name in servers:
+            return self.drop(session, u"Server {0} exists".format(name))
+
+        message["hops"] += 1
+        servers.update(Peer(name, message["info"], message["hops"], message["uplink"], session.name))
+
+        self.forward(session, message)
+
+    @handler(False)
+    def _on_squit(self, session, message):
+        peer = servers.get(message["name"])
+        if peer is not None and casefold(peer.via) == casefold(session.name):
+            self.split(peer, session)
+
+    @handler(False)
+    def _on_user(self, session, message):
+        uid = message["uid"]
+        fields = dict((field, message[field]) for field in FIELDS if field in message)
+
+        user = self.uids.get(uid)
+        if user is None:
+            # Updates of users we have not been introduced to are passed on
+            if u"nick" not in fields:
+                return self.forward(session, message)
+
+            if not self.collide(uid, fields[u"nick"], message["ts"]):
+                return
+
+            user = User(sock=Remote(server=message["origin"]), registered=True)
+            self.uids[uid] = user
+            self.ids[user] = uid
+        elif u"nick" in fields and casefold(fields[u"nick"]) != casefold(user.nick):
+            if not self.collide(uid, fields[u"nick"], message["ts"]):
+                return
+
+        if u"ts" in message:
+            self.ts[user] = message["ts"]
+
+        event = apply(user, fields)
+        if event is not None:
+            self.fire(event, "server")
+
+        self.forward(session, message)
+
+    @handler(False)
+    def _on_cmd(self, session, message):
+        if message["c"] not in COMMANDS:
+            self.logger.warn(u"Refused link command: {0}".format(message))
+            return
+
+        self.forward(session, message)
+
+        user = self.uids.get(message["uid"])
+        if user is None:
+            return
+
+        if user.sock not in connections:
+            # Killed here already
+            self.forget(user)
+            return
+
+        # Event names must be native strings, JSON decodes to unicode
+        self.fire(response.create(str(message["c"]), user.sock, user.source, *message["a"]), "server")
+
+        if message["c"] == u"quit":
+            self.forget(user)
+
+    @handler(False)
+    def _on_kill(self, session, message):
+        self.forward(session, message)
+
+        user = self.find(message["uid"])
+        if user is None:
+            return
+
+        self.expel(user, message.get("reason") or u"Killed")
+
+    @handler(False)
+    def _on_channel(self, session, message):
+        self.forward(session, message)
+
+        ts = message["ts"]
+        created = datetime.utcfromtimestamp(ts)
+
+        channel = channels.get(message["name"])
+        if channel is None:
+            channel = Channel(
+                message["name"], flags=message["flags"], topic=message["topic"], created=created
+            )
+            modes = True
+        else:
+            mine = timestamp(channel.created)
+            flags, topic, changes = channel.flags, channel.topic, []
+            if ts < mine:
+                # The older channel wins, privileges given here are void
+                channel.created = created
+                channel.flags = message["flags"]
+                channel.topic = message["topic"]
+                for user, member in channel.members.items():
+                    if member.flags:
+                        changes.extend((u"-", mode, user.nick) for mode in member.modes)
+                        member.flags = 0
+                        if user.local:
+                            member.save()
+                channel.invalidate()
+            elif ts == mine:
+                channel.flags |= message["flags"]
+                if channel.topic is None:
+                    channel.topic = message["topic"]
+
+            if any(user.local for user in channel.members):
+                channel.save()
+
+            for i, mode in reversed(list(enumerate(Channel.MODES))):
+                if (channel.flags ^ flags) & (1 << i):
+                    changes.insert(0, (u"+" if channel.flags & (1 << i) else u"-", mode, None))
+
+            self.announce(channel, changes, channel.topic != topic)
+
+            modes = ts <= mine
+
+        for uid, flags in message["members"]:
+            user = self.uids.get(uid)
+            if user is None:
+                continue
+
+            if channel.join(user, flags if modes else u"") is not None:
+                local = [member for member in channel.members if member.local]
+                self.fire(broadcast(local, Message(u"JOIN", channel.name, prefix=user.prefix)), "server")
@@ -1,6 +1,3 @@
-from itertools import chain
-
-
 from circuits import handler
 
 from circuits.protocols.irc import joinprefix, reply
@@ -11,7 +8,7 @@ from circuits.protocols.irc.replies import ERR_CANNOTSENDTOCHAN
 
 
 from ..plugin import BasePlugin
-from ..models import Channel, User
+from ..models import channels, connections
 from ..commands import BaseCommands
 
 
@@ -19,21 +16,21 @@ class Commands(BaseCommands):
 
     @handler("privmsg", "notice")
     def on_privmsg_or_notice(self, event, sock, source, target, message):
-        user = User.objects.filter(sock=sock).first()
+        user = event.context.user
 
         prefix = user.prefix or joinprefix(*source)
 
         if target.startswith(u"#"):
-            channel = Channel.objects.filter(name=target).first()
+            channel = channels.get(target)
             if channel is None:
                 return ERR_NOSUCHCHANNEL(target)
 
-            if "n" in channel.modes:
-                if not user.oper and user not in channel.users:
+            if channel.flags & channel.NOEXTERNAL:
+                if not user.oper and user not in channel.members:
                     return ERR_CANNOTSENDTOCHAN(channel.name)
 
-            if "m" in channel.modes:
-                if not user.oper and user not in chain(channel.operators, channel.voiced):
+            if channel.flags & channel.MODERATED:
+                if not user.oper and not (channel.is_operator(user) or channel.is_voiced(user)):
                     return ERR_CANNOTSENDTOCHAN(channel.name)
 
             self.notify(
@@ -42,7 +39,7 @@ class Commands(BaseCommands):
                 user
             )
         else:
-            user = User.objects.filter(nick=target).first()
+            user = connections.find(target)
             if user is None:
                 return ERR_NOSUCHNICK(target)
 
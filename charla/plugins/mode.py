@@ -1,163 +1,172 @@
-from itertools import imap
-from operator import attrgetter
-
-
 from six import u
-from funcy import take
 
+from circuits.protocols.irc import Message
 from circuits.protocols.irc.replies import ERR_NEEDMOREPARAMS, ERR_NOSUCHCHANNEL, ERR_NOSUCHNICK
 from circuits.protocols.irc.replies import MODE, RPL_UMODEIS, RPL_CHANNELMODEIS, ERR_USERSDONTMATCH
 from circuits.protocols.irc.replies import ERR_CHANOPRIVSNEEDED, ERR_UNKNOWNMODE, ERR_USERNOTINCHANNEL
 
 
 from ..plugin import BasePlugin
-from ..models import Channel, User
+from ..models import channels, connections
 from ..commands import BaseCommands
 
 
-def process_channel_mode(user, channel, mode, *args, **kwargs):
-    op = kwargs.get("op", None)
+# Maximum number of modes with a parameter applied per MODE command
+MAXMODES = 4
 
-    if op is not None and not user.oper and user not in channel.operators:
-        yield False, ERR_CHANOPRIVSNEEDED(channel.name)
-        return
 
-    if op == u("+"):
-        if mode in channel.modes:
-            yield False, None
-            return
-        channel.modes += mode
-    else:
-        if mode not in channel.modes:
-            yield False, None
-            return
-        channel.modes = channel.modes.replace(mode, u(""))
+# mode -> number of parameters
+channel_modes = {
+    u("m"): 0,
+    u("n"): 0,
+    u("t"): 0,
+    u("o"): 1,
+    u("v"): 1,
+}
 
-    channel.save()
 
-    yield True, MODE(channel.name, u("{0}{1}").format(op, mode), prefix=user.prefix)
+# mode -> number of parameters
+user_modes = {
+    u("o"): 0,
+    u("i"): 0,
+}
 
 
-def process_channel_mode_ov(user, channel, mode, *args, **kwargs):
-    op = kwargs.get("op", None)
+def parse_modes(args, modes):
+    """Parse the arguments of a MODE command
 
-    if op is not None and not user.oper and user not in channel.operators:
-        yield False, ERR_CHANOPRIVSNEEDED(channel.name)
-        return
+    Yields ``(op, mode, param)`` for each mode letter in args using the
+    table modes to consume parameters. Both ``+ov a b`` and
+    ``+o a +v b`` forms are accepted; a missing sign means ``+``.
+    Unknown modes are yielded with ``op`` set to ``None``.
+    """
 
-    nick = args[0]
-    if nick not in imap(attrgetter("nick"), channel.users):
-        yield False, ERR_USERNOTINCHANNEL(nick, channel.name)
-        return
+    nparams = 0
+    args = iter(args)
+    for arg in args:
+        op = u("+")
+        for mode in arg:
+            if mode in u("+-"):
+                op = mode
+                continue
 
-    nick = User.objects.filter(nick=nick).first()
+            if mode not in modes:
+                yield None, mode, None
+                continue
 
-    if mode == u("o"):
-        collection = channel.operators
-    elif mode == u("v"):
-        collection = channel.voiced
+            param = None
+            if modes[mode]:
+                param = next(args, None)
+                nparams += 1
+                if nparams > MAXMODES:
+                    continue
 
-    if op == u("+"):
-        collection.append(nick)
-        channel.save()
+            yield op, mode, param
 
-        yield True, MODE(channel.name, u("{0}{1}").format(op, mode), [nick.nick], prefix=user.prefix)
-    elif op == u("-"):
-        collection.remove(nick)
-        channel.save()
 
-        yield True, MODE(channel.name, u("{0}{1}").format(op, mode), [nick.nick], prefix=user.prefix)
+def format_modes(changes):
+    """Return the combined mode string and parameters of changes"""
 
+    modes, params, last = [], [], None
+    for op, mode, param in changes:
+        if op != last:
+            modes.append(op)
+            last = op
+        modes.append(mode)
+        if param is not None:
+            params.append(param)
 
-channel_modes = {
-    u("m"): (0, process_channel_mode),
-    u("n"): (0, process_channel_mode),
-    u("t"): (0, process_channel_mode),
-    u("o"): (1, process_channel_mode_ov),
-    u("v"): (1, process_channel_mode_ov),
-}
+    return u("").join(modes), params
+
+
+def process_channel_modes(user, channel, args):
+    """Apply all the modes of a MODE command to channel at once
+
+    Returns a list of the ``(op, mode, param)`` changes actually made
+    and a list of error replies.
+    """
+
+    changes, errors = [], []
+
+    operator = user.oper or channel.is_operator(user)
+
+    flags, members = channel.flags, set()
 
+    for op, mode, param in parse_modes(args, channel_modes):
+        if op is None:
+            errors.append(ERR_UNKNOWNMODE(mode))
+            continue
 
-def process_channel_modes(user, channel, modes):
-    op = None
-    modes = iter(modes)
-    while True:
-        try:
-            mode = next(modes)
-
-            if mode and mode[0] == u("+"):
-                op = u("+")
-                mode = mode[1:]
-            elif mode and mode[0] == u("-"):
-                op = u("-")
-                mode = mode[1:]
-
-            if mode not in channel_modes:
-                yield False, ERR_UNKNOWNMODE(mode)
-            else:
-                nargs, f = channel_modes[mode]
-                for notify, message in f(user, channel, mode, *take(nargs, modes), op=op):
-                    yield notify, message
-        except StopIteration:
+        if not operator:
+            errors.append(ERR_CHANOPRIVSNEEDED(channel.name))
             break
 
+        if not channel_modes[mode]:
+            if channel.set_mode(mode, op == u("+")):
+                changes.append((op, mode, None))
+            continue
 
-def process_user_mode(user, mode, op=None):
-    if op == u("+"):
-        if mode in user.modes:
-            return
-        if mode == "o":
-            return
-        user.modes += mode
-    else:
-        if mode not in user.modes:
-            return
-        user.modes = user.modes.replace(mode, u(""))
+        if param is None:
+            errors.append(ERR_NEEDMOREPARAMS(u("MODE")))
+            continue
 
-    user.save()
+        nick = connections.find(param)
+        member = channel.members.get(nick) if nick is not None else None
+        if member is None:
+            errors.append(ERR_USERNOTINCHANNEL(param, channel.name))
+            continue
 
-    return MODE(user.nick, u("{0}{1}").format(op, mode), prefix=user.nick)
+        if member.set_mode(mode, op == u("+")):
+            members.add(member)
+            changes.append((op, mode, nick.nick))
 
+    if channel.flags != flags:
+        channel.save()
 
-user_modes = {
-    u("o"): (0, process_user_mode),
-    u("i"): (0, process_user_mode),
-}
+    if members:
+        for member in members:
+            member.save()
+        channel.invalidate()
 
+    return changes, errors
 
-def process_user_modes(user, modes):
-    op = None
-    modes = iter(modes)
-    while True:
-        try:
-            mode = next(modes)
-
-            if mode and mode[0] == u("+"):
-                op = u("+")
-                mode = mode[1:]
-            elif mode and mode[0] == u("-"):
-                op = u("-")
-                mode = mode[1:]
-
-            if mode not in user_modes:
-                yield ERR_UNKNOWNMODE(mode)
-            else:
-                nargs, f = user_modes[mode]
-                yield f(user, mode, op=op)
-        except StopIteration:
-            break
 
+def process_user_modes(user, args):
+    """Apply all the modes of a MODE command to user at once
 
-class Commands(BaseCommands):
+    Returns a list of the ``(op, mode, param)`` changes actually made
+    and a list of error replies.
+    """
+
+    changes, errors = [], []
+
+    for op, mode, param in parse_modes(args, user_modes):
+        if op is None:
+            errors.append(ERR_UNKNOWNMODE(mode))
+            continue
+
+        # Operator status is only granted by OPER
+        if op == u("+") and mode == u("o"):
+            continue
 
-    def _process_channel_modes(self, user, channel, modes):
-        for notify, message in process_channel_modes(user, channel, modes):
-            if notify:
-                self.notify(channel.users[:], message)
-            elif message is not None:
-                yield message
+        if not user.set_mode(mode, op == u("+")):
+            continue
 
-    def mode(self, sock, source, *args):
+        changes.append((op, mode, None))
+
+        if mode == u("i"):
+            for channel in user.channels:
+                channel.nvisible += -1 if op == u("+") else 1
+
+    if changes:
+        user.save()
+
+    return changes, errors
+
+
+class Commands(BaseCommands):
+
+    def mode(self, event, sock, source, *args):
         """MODE command
 
         This command allows the user to display modes of another user
@@ -167,13 +176,13 @@ class Commands(BaseCommands):
         if not args:
             return ERR_NEEDMOREPARAMS(u"MODE")
 
-        user = User.objects.filter(sock=sock).first()
+        user = event.context.user
 
         args = iter(args)
         mask = next(args)
 
         if mask.startswith(u("#")):
-            channel = Channel.objects.filter(name=mask).first()
+            channel = channels.get(mask)
             if channel is None:
                 return ERR_NOSUCHCHANNEL(mask)
 
@@ -181,20 +190,35 @@ class Commands(BaseCommands):
             if mode is None:
                 return RPL_CHANNELMODEIS(channel.name, u("+{0}").format(channel.modes))
 
-            return self._process_channel_modes(user, channel, [mode] + list(args))
+            changes, errors = process_channel_modes(user, channel, [mode] + list(args))
+            if changes:
+                modes, params = format_modes(changes)
+                # Each parameter is an argument of its own, MODE would
+                # send them as one trailing argument
+                self.notify(
+                    channel.users,
+                    Message(u("MODE"), channel.name, modes, *params, prefix=user.prefix)
+                )
+
+            return errors
         else:
-            nick = User.objects.filter(nick=mask).first()
+            nick = connections.find(mask)
             if nick is None:
                 return ERR_NOSUCHNICK(mask)
 
-            if user.nick != nick.nick:
+            if user is not nick:
                 return ERR_USERSDONTMATCH()
 
             mode = next(args, None)
             if mode is None:
                 return RPL_UMODEIS(u("+{0}").format(nick.modes))
 
-            return process_user_modes(nick, [mode] + list(args))
+            changes, errors = process_user_modes(nick, [mode] + list(args))
+            if changes:
+                modes, _ = format_modes(changes)
+                errors.insert(0, MODE(nick.nick, modes, prefix=nick.nick))
+
+            return errors
 
 
 class Mode(BasePlugin):
@@ -202,10 +226,11 @@ class Mode(BasePlugin):
     def init(self, *args, **kwargs):
         super(Mode, self).init(*args, **kwargs)
 
-        self.chanmodes = u",,,nt"
+        self.chanmodes = u",,,mnt"
 
         self.features = (
             u"CHANMODES={0}".format(self.chanmodes),
+            u"MODES={0}".format(MAXMODES),
         )
 
         Commands(*args, **kwargs).register(self)
@@ -1,7 +1,14 @@
-from circuits.protocols.irc import Message
+from time import time
 
 
+from circuits import handler
+from circuits.protocols.irc import reply, Message
+
+
+from ..wheel import timers
+from ..metrics import metrics
 from ..plugin import BasePlugin
+from ..models import connections
 from ..commands import BaseCommands
 
 
@@ -10,10 +17,91 @@ class Commands(BaseCommands):
     def ping(self, sock, source, server):
         return Message(u"PONG", server)
 
+    def pong(self, sock, source, *args):
+        # Any line read counts as activity (see Ping.read)
+        pass
+
 
 class Ping(BasePlugin):
+    """Keepalive and timeouts of client connections
+
+    A connection not registered within ``registertimeout`` seconds is
+    dropped. A registered client that has sent nothing for
+    ``pinginterval`` seconds is sent a PING and dropped if it still
+    sends nothing within ``pingtimeout`` seconds, so half-open
+    connections do not linger. Each connection has a single timer on
+    the timing wheel which is only rescheduled when it fires, reading a
+    line merely records the time.
+    """
 
     def init(self, *args, **kwargs):
         super(Ping, self).init(*args, **kwargs)
 
+        self.interval = self.config["pinginterval"]
+        self.timeout = self.config["pingtimeout"]
+        self.registration = self.config["registertimeout"]
+
+        # sock -> time a line was last read
+        self.active = {}
+
+        # sock -> time an unanswered PING was sent
+        self.pinged = {}
+
+        # sock -> charla.wheel.Timer
+        self.timers = {}
+
         Commands(*args, **kwargs).register(self)
+
+        # Connections resumed after a hot restart
+        for user in connections:
+            if user.local:
+                self.watch(user.sock, self.interval if user.registered else self.registration)
+
+    @handler(False)
+    def watch(self, sock, delay):
+        self.active[sock] = time()
+        self.timers[sock] = timers.schedule(delay, self.check, sock)
+
+    @handler(False)
+    def check(self, sock):
+        user = connections.get(sock)
+        if user is None or sock not in self.active:
+            return
+
+        if not user.registered:
+            metrics.incr("timeout.registration")
+            self.server.drop(sock, u"Registration timed out")
+            return
+
+        now = time()
+        idle = now - self.active[sock]
+
+        pinged = self.pinged.pop(sock, None)
+        if pinged is not None and self.active[sock] < pinged:
+            metrics.incr("timeout.ping")
+            self.server.drop(sock, u"Ping timeout: {0} seconds".format(int(idle)))
+            return
+
+        if idle < self.interval:
+            delay = self.interval - idle
+        else:
+            self.pinged[sock] = now
+            self.fire(reply(sock, Message(u"PING", self.server.host)))
+            delay = self.timeout
+
+        self.timers[sock] = timers.schedule(delay, self.check, sock)
+
+    def connect(self, sock, *args):
+        self.watch(sock, self.registration)
+
+    def disconnect(self, sock):
+        self.active.pop(sock, None)
+        self.pinged.pop(sock, None)
+
+        timer = self.timers.pop(sock, None)
+        if timer is not None:
+            timer.cancel()
+
+    def read(self, sock, data):
+        if sock in self.active:
+            self.active[sock] = time()
@@ -1,5 +1,7 @@
+from time import time
 from inspect import getargspec
 from types import GeneratorType
+from collections import namedtuple
 
 
 from cidict import cidict
@@ -15,8 +17,34 @@ from circuits.protocols.irc.replies import ERR_UNKNOWNCOMMAND
 from circuits.protocols.irc.replies import ERR_NEEDMOREPARAMS, ERR_NOTREGISTERED
 
 
-from ..models import User
+from ..bus import relay, COMMANDS
+from ..context import Context
 from ..plugin import BasePlugin
+from ..metrics import metrics, COUNTS
+from ..models import connections, Remote
+
+
+Command = namedtuple("Command", ("component", "handler", "minargs", "maxargs"))
+
+
+def arity(handler):
+    """Return the (minimum, maximum) number of command parameters handler accepts
+
+    ``sock`` and ``source`` are not counted. The maximum is ``None`` if the
+    handler accepts a variable number of parameters.
+    """
+
+    argspec = getargspec(handler)
+
+    args = list(argspec.args)
+    for skip in ("self", "event",):
+        if args and args[0] == skip:
+            del args[0]
+
+    args = args[2:]
+    ndefaults = len(argspec.defaults or ())
+
+    return len(args) - ndefaults, None if argspec.varargs else len(args)
 
 
 class Processor(BasePlugin):
@@ -24,8 +52,8 @@ class Processor(BasePlugin):
     def init(self, *args, **kwargs):
         super(Processor, self).init(*args, **kwargs)
 
-        # command -> plugin
-        self.command = cidict()
+        # command -> Command
+        self.dispatch = cidict()
 
         # plugin name -> commands
         self.commands = cidict()
@@ -33,12 +61,21 @@ class Processor(BasePlugin):
         # plugin name -> plugin
         self.plugins = cidict()
 
+        # Relay the commands of local users to other worker processes
+        # or linked servers
+        self.relaying = (
+            self.config["workers"] > 1
+            or bool(self.config.get("links") or self.config.get("linkport"))
+        )
+
     @handler("registered", channel="*")
     def _on_registered(self, component, manager):
         if component.channel == "commands":
-            for event in component.events():
-                if event not in self.command:
-                    self.command[event] = component
+            for f in type(component).handlers():
+                for name in f.names:
+                    if name.startswith("_") or name in self.dispatch:
+                        continue
+                    self.dispatch[name] = Command(component, f, *arity(f))
 
             if component.parent.name in self.commands:
                 events = self.commands[component.parent.name]
@@ -54,9 +91,9 @@ class Processor(BasePlugin):
     @handler("unregistered", channel="*")
     def _on_unregistered(self, component, manager):
         if component.channel == "commands":
-            for event in component.events():
-                if event in self.command:
-                    del self.command[event]
+            for name, command in list(self.dispatch.items()):
+                if command.component is component:
+                    del self.dispatch[name]
 
         if isinstance(component, BasePlugin):
             if component.name in self.commands:
@@ -65,25 +102,52 @@ class Processor(BasePlugin):
                 del self.plugins[component.name]
 
     def quit_complete(self, e, value):
-        sock = e.args[0]
-        user = User.objects.filter(sock=sock).first()
+        user = e.context.user
         if user is None:
             return
 
         user.delete()
 
     def broadcast(self, users, message, *exclude):
-        for user in users:
-            if user in exclude:
-                continue
+        start = time()
+
+        # Users on other workers are delivered to by their own worker
+        skip = set(user.sock for user in exclude)
+        socks = [
+            user.sock for user in users
+            if user.sock not in skip and not isinstance(user.sock, Remote)
+        ]
 
-            self.fire(reply(user.sock, message))
+        if message.add_nick:
+            # Recipient specific so it cannot be encoded once
+            for sock in socks:
+                self.fire(reply(sock, message))
+            return
+
+        if message.prefix is None:
+            message.prefix = self.server.host
+
+        self.server.send(socks, bytes(message))
 
-    def reply(self, sock, message):
-        user = User.objects.filter(sock=sock).first()
+        metrics.incr("fanout.lines")
+        metrics.incr("fanout.recipients", len(socks))
+        metrics.observe("fanout.size", len(socks), COUNTS)
+        metrics.observe("fanout.time", time() - start)
+
+    def reply(self, sock, message, context=None):
+        if isinstance(sock, Remote):
+            return
 
         if message.add_nick:
-            message.args.insert(0, user.nick or u"")
+            if context is None:
+                context = Context(sock, connections.get(sock))
+
+            # Copied as broadcast shares the message between recipients
+            message = Message(
+                message.command, context.nick or u"", *message.args,
+                prefix=self.server.host if message.prefix is None else message.prefix,
+                encoding=message.encoding
+            )
 
         if message.prefix is None:
             message.prefix = self.server.host
@@ -111,7 +175,7 @@ class Processor(BasePlugin):
 
             for value in values:
                 if isinstance(value, Message):
-                    self.fire(reply(sock, value))
+                    self.fire(reply(sock, value, e.context))
                 elif isinstance(value, Event):
                     self.fire(value)
                 else:
@@ -127,29 +191,27 @@ class Processor(BasePlugin):
                     )
         elif isinstance(event, response):
             sock = args[0]
-            user = User.objects.filter(sock=sock).first()
+            context = event.context = Context(sock, connections.get(sock))
 
-            if user and not user.registered and event.name not in ("nick", "pass", "user",):
-                return self.fire(reply(sock, ERR_NOTREGISTERED()))
+            if context.user and not context.registered and event.name not in ("nick", "pass", "user",):
+                return self.fire(reply(sock, ERR_NOTREGISTERED(), context))
 
-            if event.name not in self.command:
+            command = self.dispatch.get(event.name)
+            if command is None:
                 event.stop()
-                return self.fire(reply(sock, ERR_UNKNOWNCOMMAND(event.name)))
+                return self.fire(reply(sock, ERR_UNKNOWNCOMMAND(event.name), context))
 
-            component = self.command[event.name]
-            handlers = (x for x in type(component).handlers() if event.name in x.names)
-            handler = next(handlers, None)
-            assert handler is not None
+            nargs = len(args) - 2
+            if nargs < command.minargs:
+                event.stop()
+                return self.fire(reply(sock, ERR_NEEDMOREPARAMS(event.name), context))
 
-            argspec = getargspec(handler)
-            args = list(argspec.args)
-            for skip in ("self", "event",):
-                if args and args[0] == skip:
-                    del args[0]
+            # Excess parameters are ignored rather than passed on to handlers
+            if command.maxargs is not None and nargs > command.maxargs:
+                event.args = list(event.args[:2 + command.maxargs])
 
-            if len(args) < (len(args) - len(argspec.defaults or ())):
-                event.stop()
-                return self.fire(reply(sock, ERR_NEEDMOREPARAMS(event.name)))
+            if self.relaying and context.registered and event.name in COMMANDS and context.user.local:
+                self.fire(relay(context.user, event.name, list(event.args[2:])), "bus")
 
             event.complete = True
             event.complete_channels = ("server",)
@@ -1,8 +1,9 @@
 from six import u
 
 
+from circuits.protocols.irc.replies import _M
 from circuits.protocols.irc.replies import ERR_NONICKNAMEGIVEN, ERR_NOMOTD, RPL_LUSEROP
-from circuits.protocols.irc.replies import RPL_LUSERCLIENT, RPL_LUSERCHANNELS, RPL_LUSERME
+from circuits.protocols.irc.replies import RPL_LUSERCHANNELS, RPL_LUSERME
 from circuits.protocols.irc.replies import RPL_MOTDSTART, RPL_MOTD, RPL_ENDOFMOTD, RPL_WHOISOPERATOR
 from circuits.protocols.irc.replies import ERR_NOSUCHNICK, ERR_NOSUCHCHANNEL, RPL_WHOREPLY, RPL_ENDOFWHO
 from circuits.protocols.irc.replies import RPL_WHOISUSER, RPL_WHOISCHANNELS, RPL_WHOISSERVER, RPL_ENDOFWHOIS
@@ -13,21 +14,50 @@ from ..plugin import BasePlugin
 from ..commands import BaseCommands
 
 
+def RPL_LUSERCLIENT(nusers, ninvisible, nservers):
+    return _M(
+        u"251",
+        u"There are {0} users and {1} invisible on {2} servers".format(
+            nusers - ninvisible, ninvisible, nservers
+        )
+    )
+
+
+def RPL_LUSERUNKNOWN(nunknown):
+    return _M(u"253", u"{0}".format(nunknown), u"unknown connection(s)")
+
+
+def RPL_LOCALUSERS(nusers, maxusers):
+    return _M(
+        u"265", u"{0}".format(nusers), u"{0}".format(maxusers),
+        u"Current local users {0}, max {1}".format(nusers, maxusers)
+    )
+
+
+def RPL_GLOBALUSERS(nusers, maxusers):
+    return _M(
+        u"266", u"{0}".format(nusers), u"{0}".format(maxusers),
+        u"Current global users {0}, max {1}".format(nusers, maxusers)
+    )
+
+
 class Commands(BaseCommands):
 
     def lusers(self, sock, source):
-        users = models.User.objects.all()
-        nusers = len(users)
-        nchannels = len(models.Channel.objects.all())
-        noperators = len([x for x in users if u"o" in x.modes])
-        nservices = 0
-        nservers = 1
+        connections = models.connections
+
+        nusers = connections.nusers
+        maxusers = connections.maxusers
+        nservers = len(models.servers) + 1
 
         return [
-            RPL_LUSERCLIENT(nusers, nservices, nservers),
-            RPL_LUSERCHANNELS(nchannels),
-            RPL_LUSEROP(noperators),
-            RPL_LUSERME(nusers, nservers),
+            RPL_LUSERCLIENT(nusers, connections.ninvisible, nservers),
+            RPL_LUSEROP(connections.noperators),
+            RPL_LUSERUNKNOWN(connections.nunknown),
+            RPL_LUSERCHANNELS(len(models.channels)),
+            RPL_LUSERME(connections.nlocal, nservers),
+            RPL_LOCALUSERS(connections.nlocal, connections.maxlocal),
+            RPL_GLOBALUSERS(nusers, maxusers),
         ]
 
     def motd(self, sock, source):
@@ -50,19 +80,20 @@ class Commands(BaseCommands):
 
         mask = next(args, None)
 
-        user = models.User.objects.filter(nick=mask).first()
+        user = models.connections.find(mask)
         if user is None:
             return ERR_NOSUCHNICK(mask)
 
-        userinfo = user.userinfo
         server = self.parent.server
 
         channels = []
         for channel in user.channels:
+            member = channel.members[user]
+
             prefix = ""
-            if user in channel.operators:
+            if member.operator:
                 prefix += "@"
-            if user in channel.voiced:
+            if member.voiced:
                 prefix += "+"
             channels.append(u"{0}{1}".format(prefix, channel.name))
 
@@ -72,9 +103,13 @@ class Commands(BaseCommands):
 
         replies = []
 
-        replies.append(RPL_WHOISUSER(user.nick, userinfo.user, userinfo.host, userinfo.name))
+        replies.append(RPL_WHOISUSER(user.nick, user.username, user.hostname, user.realname))
         replies.append(RPL_WHOISCHANNELS(user.nick, channels))
-        replies.append(RPL_WHOISSERVER(user.nick, server.host, server.info))
+        peer = models.servers.get(user.origin) if user.origin else None
+        if peer is not None:
+            replies.append(RPL_WHOISSERVER(user.nick, peer.name, peer.info))
+        else:
+            replies.append(RPL_WHOISSERVER(user.nick, server.host, server.info))
 
         if user.oper:
             replies.append(RPL_WHOISOPERATOR(user.nick))
@@ -85,43 +120,39 @@ class Commands(BaseCommands):
 
     def who(self, sock, source, mask):
         if mask.startswith(u"#"):
-            channel = models.Channel.objects.filter(name=mask).first()
+            channel = models.channels.get(mask)
             if channel is None:
                 return ERR_NOSUCHCHANNEL(mask)
 
             replies = []
-            for user in channel.users:
-                userinfo = user.userinfo
-
+            for user, member in channel.members.items():
                 status = u("G") if user.away else u("H")
                 status += (u("*") if user.oper else u(""))
-                status += (u("@") if user in channel.operators else u(""))
-                status += (u("+") if user in channel.voiced else u(""))
+                status += (u("@") if member.operator else u(""))
+                status += (u("+") if member.voiced else u(""))
 
                 replies.append(
                     RPL_WHOREPLY(
-                        channel.name, userinfo.user, userinfo.host,
-                        self.parent.server.host, user.nick, status,
-                        0, userinfo.name or ""
+                        channel.name, user.username, user.hostname,
+                        user.origin or self.parent.server.host, user.nick, status,
+                        0, user.realname or ""
                     )
                 )
             replies.append(RPL_ENDOFWHO(mask))
             return replies
         else:
-            user = models.User.objects.filter(nick=mask).first()
+            user = models.connections.find(mask)
             if user is None:
                 return ERR_NOSUCHNICK(mask)
 
-            userinfo = user.userinfo
-
             status = u("G") if user.away else u("H")
             status += (u("*") if user.oper else u(""))
 
             return (
                 RPL_WHOREPLY(
-                    mask, userinfo.user, userinfo.host,
-                    self.parent.server.host, user.nick, status,
-                    0, userinfo.naem
+                    mask, user.username, user.hostname,
+                    user.origin or self.parent.server.host, user.nick, status,
+                    0, user.realname or ""
                 ),
                 RPL_ENDOFWHO(mask)
             )
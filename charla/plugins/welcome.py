@@ -1,3 +1,4 @@
+from datetime import datetime
 from itertools import chain
 
 
@@ -8,7 +9,9 @@ from circuits.protocols.irc.replies import RPL_WELCOME, RPL_YOURHOST, RPL_CREATE
 
 from .mode import channel_modes, user_modes
 
+from ..metrics import metrics, REGISTRATION
 from ..plugin import BasePlugin
+from ..models import connections
 
 
 class supports(Event):
@@ -20,6 +23,12 @@ class Welcome(BasePlugin):
     def signon(self, sock, source):
         version = u"{0}-{1}".format(self.server.name, self.server.version)
 
+        user = connections.get(sock)
+        if user is not None:
+            # Time from connecting to being welcomed
+            elapsed = datetime.utcnow() - user.signon
+            metrics.observe("registration.time", elapsed.total_seconds(), REGISTRATION)
+
         umodes = u"".join(user_modes.keys())
         chmodes = u"".join(channel_modes.keys())
 
@@ -0,0 +1,381 @@
+"""Resolver Module
+
+Non-blocking DNS resolver used to look up the hostnames of clients.
+
+The resolver speaks DNS over UDP to a single nameserver but performs no
+I/O itself: queries are sent with the ``send`` callable it is given and
+datagrams received from the nameserver are handed to
+:meth:`Resolver.receive`. This lets it be driven by the server's event
+loop (see :mod:`charla.plugins.checkhost`) as well as by tests against
+a stand-in nameserver.
+"""
+
+
+import re
+from time import time
+from binascii import hexlify
+from struct import pack, unpack_from, error as StructError
+from random import getrandbits
+from functools import partial
+from collections import deque, OrderedDict
+from socket import inet_ntop, inet_pton, AF_INET, AF_INET6
+from socket import error as SocketError
+
+
+from .metrics import metrics
+
+
+A = 1
+PTR = 12
+AAAA = 28
+
+CLASS_IN = 1
+
+# Response codes
+NOERROR = 0
+NXDOMAIN = 3
+
+# Seconds to wait for an answer to a single query
+TIMEOUT = 5
+
+# Seconds to cache failed lookups for
+NEGTTL = 300
+
+# Upper bound on the TTL of successful lookups
+MAXTTL = 86400
+
+MISSING = object()
+
+# Hostnames are used in every nick!user@host prefix of the user
+LABEL = re.compile(r"^[A-Za-z0-9-]{1,63}$")
+
+
+def nameserver(filename="/etc/resolv.conf"):
+    """Return the first nameserver configured in filename"""
+
+    try:
+        with open(filename) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == "nameserver":
+                    return fields[1]
+    except IOError:
+        pass
+
+    return "127.0.0.1"
+
+
+def normalize(address):
+    """Return address in canonical form
+
+    IPv4-mapped IPv6 addresses (as accepted by a dual stack listener)
+    are returned as plain IPv4 addresses. The zone of scoped IPv6
+    addresses (``fe80::1%eth0``) is dropped.
+    """
+
+    address = address.split("%", 1)[0]
+
+    if address.startswith("::ffff:") and "." in address:
+        address = address[7:]
+
+    family = AF_INET6 if ":" in address else AF_INET
+    return inet_ntop(family, inet_pton(family, address))
+
+
+def reverse_name(address):
+    """Return the in-addr.arpa or ip6.arpa name of address"""
+
+    if ":" in address:
+        digits = hexlify(inet_pton(AF_INET6, address)).decode("ascii")
+        return ".".join(reversed(digits)) + ".ip6.arpa"
+
+    return ".".join(reversed(address.split("."))) + ".in-addr.arpa"
+
+
+def valid_hostname(name):
+    """Return True if name is made only of letters, digits and hyphens"""
+
+    if not name or len(name) > 253:
+        return False
+
+    return all(LABEL.match(label) for label in name.split(u"."))
+
+
+def encode_name(name):
+    data = bytearray()
+    for label in name.rstrip(".").split("."):
+        label = label.encode("idna")
+        data.append(len(label))
+        data.extend(label)
+    data.append(0)
+    return bytes(data)
+
+
+def decode_name(data, offset):
+    """Decode the possibly compressed name at offset
+
+    Returns the name and the offset following it.
+    """
+
+    labels, end, jumps = [], None, 0
+    while True:
+        if offset >= len(data):
+            raise ValueError("Truncated name")
+
+        n = bytearray(data[offset:offset + 1])[0]
+        if n & 0xc0 == 0xc0:
+            jumps += 1
+            if jumps > 16:
+                raise ValueError("Compression loop")
+            if end is None:
+                end = offset + 2
+            offset = unpack_from("!H", data, offset)[0] & 0x3fff
+        elif n:
+            labels.append(data[offset + 1:offset + 1 + n].decode("ascii"))
+            offset += 1 + n
+        else:
+            offset += 1
+            break
+
+    return u".".join(labels), offset if end is None else end
+
+
+def build_query(id, name, type):
+    return pack("!HHHHHH", id, 0x0100, 1, 0, 0, 0) + encode_name(name) + pack("!HH", type, CLASS_IN)
+
+
+def parse_response(data):
+    """Parse a response datagram
+
+    Returns ``(id, rcode, question, answers)`` where question is the
+    ``(name, type)`` asked and answers a list of ``(name, type, ttl,
+    value)``. Values of A, AAAA and PTR records are decoded. Raises
+    ValueError if data is not a well formed response.
+    """
+
+    try:
+        id, flags, qdcount, ancount = unpack_from("!HHHH", data)
+        if not flags & 0x8000 or qdcount != 1:
+            raise ValueError("Not a response")
+
+        name, offset = decode_name(data, 12)
+        type, _ = unpack_from("!HH", data, offset)
+        offset += 4
+
+        answers = []
+        for _ in range(ancount):
+            rname, offset = decode_name(data, offset)
+            rtype, rclass, ttl, size = unpack_from("!HHIH", data, offset)
+            offset += 10
+
+            rdata = data[offset:offset + size]
+            if len(rdata) != size:
+                raise ValueError("Truncated record")
+
+            if rtype == A:
+                value = inet_ntop(AF_INET, rdata)
+            elif rtype == AAAA:
+                value = inet_ntop(AF_INET6, rdata)
+            elif rtype == PTR:
+                value = decode_name(data, offset)[0]
+            else:
+                value = rdata
+
+            answers.append((rname, rtype, ttl, value))
+            offset += size
+    except (StructError, SocketError, UnicodeError) as e:
+        raise ValueError(e)
+
+    return id, flags & 0x000f, (name, type), answers
+
+
+class Cache(object):
+    """LRU cache whose entries expire after their own TTL"""
+
+    def __init__(self, size=4096, clock=time):
+        self.size = size
+        self.clock = clock
+
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return default
+
+        value, expires = entry
+        if expires <= self.clock():
+            return default
+
+        # Most recently used entries are kept at the end
+        self.entries[key] = entry
+
+        return value
+
+    def set(self, key, value, ttl):
+        self.entries.pop(key, None)
+        self.entries[key] = (value, self.clock() + ttl)
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class Query(object):
+
+    __slots__ = ("id", "name", "type", "callback", "deadline",)
+
+    def __init__(self, id, name, type, callback, deadline):
+        self.id = id
+        self.name = name
+        self.type = type
+        self.callback = callback
+        self.deadline = deadline
+
+
+class Resolver(object):
+    """Asynchronous forward-confirmed reverse DNS resolver
+
+    At most ``maxlookups`` lookups are in progress at once; further
+    lookups wait in a queue. Concurrent lookups of the same address
+    share a single set of queries. Results, including failures, are
+    cached. :meth:`expire` must be called periodically to time out
+    unanswered queries.
+    """
+
+    def __init__(self, send, timeout=TIMEOUT, maxlookups=64,
+                 cachesize=4096, negttl=NEGTTL, clock=time):
+        self.send = send
+        self.timeout = timeout
+        self.maxlookups = maxlookups
+        self.negttl = negttl
+        self.clock = clock
+
+        self.cache = Cache(cachesize, clock)
+
+        # id -> Query awaiting an answer
+        self.queries = {}
+
+        # address -> callbacks of lookups waiting for or in progress
+        self.lookups = {}
+
+        # addresses waiting for a free lookup slot
+        self.waiting = deque()
+
+        self.active = 0
+
+    def lookup(self, address, callback):
+        """Look up the hostname of address
+
+        callback is called with the hostname once its reverse name has
+        been confirmed to resolve back to address, or with ``None``. It
+        may be called before this method returns.
+        """
+
+        address = normalize(address)
+
+        hostname = self.cache.get(address, MISSING)
+        if hostname is not MISSING:
+            metrics.incr("resolver.hits")
+            callback(hostname)
+            return
+
+        callbacks = self.lookups.get(address)
+        if callbacks is not None:
+            metrics.incr("resolver.coalesced")
+            callbacks.append(callback)
+            return
+
+        metrics.incr("resolver.misses")
+
+        self.lookups[address] = [callback]
+
+        if self.active < self.maxlookups:
+            self.start(address)
+        else:
+            self.waiting.append(address)
+
+    def start(self, address):
+        self.active += 1
+        self.query(reverse_name(address), PTR, partial(self._on_ptr, address))
+
+    def finish(self, address, hostname, ttl):
+        if ttl:
+            self.cache.set(address, hostname, min(ttl, MAXTTL))
+
+        self.active -= 1
+        if self.waiting:
+            self.start(self.waiting.popleft())
+
+        for callback in self.lookups.pop(address):
+            callback(hostname)
+
+    def query(self, name, type, callback):
+        """Send a query calling callback with the rcode and answers
+
+        On timeout callback is called with a rcode of ``None``.
+        """
+
+        id = getrandbits(16)
+        while id in self.queries:
+            id = getrandbits(16)
+
+        self.queries[id] = Query(id, name, type, callback, self.clock() + self.timeout)
+        self.send(build_query(id, name, type))
+
+    def receive(self, data):
+        """Handle a datagram received from the nameserver"""
+
+        try:
+            id, rcode, question, answers = parse_response(data)
+        except ValueError:
+            return
+
+        # Ignore stray or spoofed answers to questions we did not ask
+        query = self.queries.get(id)
+        if query is None or question[1] != query.type:
+            return
+        if question[0].lower() != query.name.rstrip(".").lower():
+            return
+
+        del self.queries[id]
+        query.callback(rcode, answers)
+
+    def expire(self):
+        """Time out queries that have not been answered in time"""
+
+        now = self.clock()
+        for id, query in list(self.queries.items()):
+            if query.deadline <= now:
+                del self.queries[id]
+                metrics.incr("resolver.timeouts")
+                query.callback(None, [])
+
+    def _on_ptr(self, address, rcode, answers):
+        names = [value for _, type, _, value in answers if type == PTR]
+        if rcode != NOERROR or not names:
+            # Timeouts are not cached, failed lookups are
+            self.finish(address, None, self.negttl if rcode is not None else 0)
+            return
+
+        name, ttl = names[0], min(ttl for _, type, ttl, _ in answers if type == PTR)
+
+        # Anyone controlling the reverse zone controls the name
+        if not valid_hostname(name):
+            metrics.incr("resolver.invalid")
+            self.finish(address, None, self.negttl)
+            return
+
+        type = AAAA if ":" in address else A
+        self.query(name, type, partial(self._on_forward, address, name, ttl))
+
+    def _on_forward(self, address, name, ttl, rcode, answers):
+        type = AAAA if ":" in address else A
+        records = [(value, t) for _, rtype, t, value in answers if rtype == type]
+
+        if rcode == NOERROR and any(normalize(value) == address for value, _ in records):
+            self.finish(address, name, min([ttl] + [t for _, t in records]))
+        else:
+            self.finish(address, None, self.negttl if rcode is not None else 0)
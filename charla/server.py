@@ -4,22 +4,29 @@ Main Listening Server Component
 """
 
 
+import os
 from datetime import datetime
-from socket import has_ipv6
+from socket import socket, error as SocketError, has_ipv6, IPPROTO_TCP, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, TCP_NODELAY
 from logging import getLogger
-from collections import defaultdict
 
 
-from circuits import Event, Component, Timer
+from circuits import handler, Event, Component, Timer
 
 from circuits.net.sockets import TCPServer, TCP6Server
 
+from circuits.net.events import write
 from circuits.protocols.irc import response, IRC
+from circuits.protocols.irc.replies import ERROR
 
 from pathlib import Path
 
 
-from .models import User
+from . import snapshot
+from .buffers import Buffers
+from .store import store
+from .events import signon
+from .metrics import metrics
+from .models import User, connections
 from . import __name__, __url__, __version__
 
 
@@ -27,6 +34,121 @@ class setup(Event):
     """setup Event"""
 
 
+class sendq_exceeded(Event):
+    """sendq_exceeded Event"""
+
+
+class SendQ(object):
+    """Per-connection send queue accounting for circuits socket servers
+
+    Keeps a running count of the bytes buffered for each client socket.
+    When a write would take a client over ``sendq`` bytes its pending
+    output is dropped, it is sent ``ERROR :SendQ exceeded`` and closed.
+
+    .. note:: This hooks the transport's private ``_write`` and ``_close``
+              methods as circuits provides no other way to observe output
+              being drained from its buffers.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.sendq = kwargs.pop("sendq", 0)
+
+        super(SendQ, self).__init__(*args, **kwargs)
+
+        self.queued = {}
+        self.exceeded = set()
+
+    @handler("write")
+    def write(self, sock, data):
+        # Closed already, nothing will ever drain it
+        if sock in self.exceeded or sock not in self._clients:
+            return
+
+        queued = self.queued.get(sock, 0) + len(data)
+        if self.sendq and queued > self.sendq:
+            self.exceeded.add(sock)
+            self._buffers[sock].clear()
+            self.queued[sock] = 0
+
+            metrics.incr("sendq.exceeded")
+
+            data = bytes(ERROR(u"SendQ exceeded"))
+            self.queued[sock] = len(data)
+            super(SendQ, self).write(sock, data)
+
+            self.close(sock)
+            self.fire(sendq_exceeded(sock))
+            return
+
+        self.queued[sock] = queued
+        super(SendQ, self).write(sock, data)
+
+    def _write(self, sock, data):
+        if sock not in self._clients:
+            return
+
+        buffer = self._buffers.get(sock, ())
+        n = len(buffer)
+
+        super(SendQ, self)._write(sock, data)
+
+        if sock not in self.queued:
+            # Closed by a failed write
+            return
+
+        queued = self.queued[sock] - len(data)
+        if len(buffer) > n:
+            # Partial write, the remainder was put back on the buffer
+            queued += len(buffer[0])
+        self.queued[sock] = queued
+
+    def _close(self, sock):
+        self.queued.pop(sock, None)
+        self.exceeded.discard(sock)
+
+        super(SendQ, self)._close(sock)
+
+
+# Not exported by the socket module of older Pythons
+SO_REUSEPORT = 15
+
+
+class ReusePort(object):
+    """Listen with ``SO_REUSEPORT`` for circuits TCP servers
+
+    Lets every worker process bind its own listening socket to the same
+    port with the kernel balancing new connections between them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.reuseport = kwargs.pop("reuseport", False)
+
+        super(ReusePort, self).__init__(*args, **kwargs)
+
+    def _create_socket(self):
+        if not self.reuseport:
+            return super(ReusePort, self)._create_socket()
+
+        sock = socket(self.socket_family, SOCK_STREAM)
+
+        sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        sock.setblocking(False)
+        sock.bind(self._bind)
+        sock.listen(self._backlog)
+
+        return sock
+
+
+class Transport(SendQ, ReusePort, TCPServer):
+    """IPv4 Transport"""
+
+
+class Transport6(SendQ, ReusePort, TCP6Server):
+    """IPv6 Transport"""
+
+
 class Server(Component):
 
     channel = "server"
@@ -52,32 +174,62 @@ class Server(Component):
 
         self.logger = getLogger(__name__)
 
-        self.buffers = defaultdict(bytes)
+        if config.get("servername"):
+            self.host = config["servername"]
+
+        self.buffers = Buffers(config["linelen"])
+        metrics.gauge("recvq.bytes", lambda: self.buffers.size)
 
         self.port = config["port"]
+        self.sendq = config["sendq"]
 
         if has_ipv6:
             self.address = "::"
-            self.Transport = TCP6Server
+            self.Transport = Transport6
         else:
             self.address = "0.0.0.0"
-            self.Transport = TCPServer
+            self.Transport = Transport
 
         self.bind = (self.address, self.port)
 
+        # sock -> reason of connections dropped by the server (see drop)
+        self.reasons = {}
+
+        # Sockets handed over by a hot restart (see RESTART)
+        self.listener, self.resumed = None, []
+        if config.get("resume"):
+            self.resume(config["resume"])
+
         self.fire(setup())
 
+    def resume(self, filename):
+        """Take over the state and connections of the process we replace"""
+
+        os.environ.pop("CHARLA_RESUME", None)
+
+        state = snapshot.load(filename)
+        os.remove(filename)
+
+        self.listener, self.resumed = snapshot.restore(state)
+
+        self.logger.info(u"Resumed {0} connection(s)".format(len(self.resumed)))
+
     def setup(self):
         try:
             self.transport = self.Transport(
-                self.bind,
+                self.listener or self.bind,
+                sendq=self.sendq,
+                reuseport=self.config["workers"] > 1,
                 channel=self.channel
             ).register(self)
 
+            metrics.gauge("sendq.bytes", lambda: sum(self.transport.queued.values()))
+
             self.protocol = IRC(
                 channel=self.channel,
-                getBuffer=self.buffers.__getitem__,
-                updateBuffer=self.buffers.__setitem__
+                getBuffer=self.buffers.get,
+                updateBuffer=self.buffers.update,
+                splitter=self.buffers.split
             ).register(self)
         except Exception as e:
             self.logger.error("Cannot start server: {0}".format(e))
@@ -91,24 +243,103 @@ class Server(Component):
             )
         )
 
+        if server is self.transport:
+            self.adopt()
+
+    def adopt(self):
+        """Serve the client connections resumed after a hot restart
+
+        .. note:: Like :class:`SendQ` this reaches into the transport's
+                  private state as circuits cannot be given connections
+                  it did not accept itself.
+        """
+
+        transport = self.transport
+        for sock, recvq, truncated, sendq, pending in self.resumed:
+            transport._clients.append(sock)
+            transport._poller.addReader(transport, sock)
+
+            buffer = self.buffers.get(sock)
+            buffer.extend(recvq)
+            buffer.truncated = truncated
+
+            if sendq:
+                self.fire(write(sock, sendq))
+
+            # Signon was waiting on a lookup lost with the old process
+            if pending:
+                self.fire(signon(sock, connections.get(sock).source))
+
+        self.resumed = []
+
     def connect(self, sock, *args):
         host, port = args[:2]
         user = User(sock=sock, host=host, port=port)
         user.save()
 
     def disconnect(self, sock):
-        user = User.objects.filter(sock=sock).first()
+        self.buffers.free(sock)
+
+        reason = self.reasons.pop(sock, "Leavling")
+
+        user = connections.get(sock)
         if user is None:
             return
 
-        nick = user.nick
-        user, host = user.userinfo.user, user.userinfo.host
+        # Registered users release their nick claim on QUIT
+        if not user.registered and user.nick is not None and self.config["workers"] > 1:
+            store.release(user.nick, user)
 
-        quit = response.create("quit", sock, (nick, user, host), "Leavling")
+        source = (user.nick, user.username, user.hostname)
+
+        quit = response.create("quit", sock, source, reason)
         quit.complete = True
         quit.complete_channels = ("server",)
 
         self.fire(quit)
 
+    @handler(False)
+    def drop(self, sock, reason):
+        """Disconnect sock at once with ``ERROR :reason``
+
+        Unlike ``close`` this discards any output still pending rather
+        than waiting for it to drain, so a client that stopped reading
+        cannot keep its connection open.
+        """
+
+        transport = self.transport
+
+        self.reasons[sock] = reason
+
+        transport._buffers.pop(sock, None)
+        if sock in transport._closeq:
+            transport._closeq.remove(sock)
+
+        try:
+            sock.send(bytes(ERROR(reason)))
+        except SocketError:
+            pass
+
+        transport._close(sock)
+
+    def sendq_exceeded(self, sock):
+        user = connections.get(sock)
+        if user is None:
+            return
+
+        self.fire(response.create("quit", sock, user.source, u"SendQ exceeded", disconnect=False))
+
+    @handler(False)
+    def send(self, socks, data):
+        """Write the same encoded data to every socket in socks
+
+        This bypasses the event system and hands data straight to the
+        transport so fanning out a line costs no per-recipient events.
+        """
+
+        write = self.transport.write
+        for sock in socks:
+            write(sock, data)
+
     def supports(self):
         return self.features
@@ -0,0 +1,326 @@
+"""Snapshot Module
+
+Capture and restore the state of the server.
+
+A hot restart (see RESTART) hands the live state of the server over to
+a new process along with the listening and client sockets, without any
+client having to reconnect. Its snapshot holds every local user and
+channel with their memberships and modes, each client's partial input
+line and undelivered output and the file descriptors of the sockets,
+which the new process inherits across ``exec``.
+
+The persistent settings of channels (see
+:class:`charla.models.Settings`) are also written periodically to a
+compact binary file and loaded at boot so that channels keep their
+modes and topic across a crash. The file is a header::
+
+    "CHSN" version:u16 count:u32
+
+followed by count records::
+
+    flags:u16 created:u32 name_length:u16 name topic_length:i32 topic
+
+in network byte order, where names and topics are UTF-8 and a topic
+length of -1 stands for no topic.
+"""
+
+
+import os
+import json
+from time import time
+from calendar import timegm
+from itertools import count
+from datetime import datetime
+from logging import getLogger
+from struct import Struct, error as StructError
+from fcntl import fcntl, F_GETFD, F_SETFD, FD_CLOEXEC
+from binascii import a2b_base64, b2a_base64
+from socket import fromfd, socket, error as SocketError, SOCK_STREAM
+
+
+from .metrics import metrics
+from .resolver import normalize
+from .models import channels, connections, dump_datetime, load_datetime, Channel, Settings, User
+
+
+MAGIC = b"CHSN"
+VERSION = 1
+
+HEADER = Struct("!4sHI")
+RECORD = Struct("!HIH")
+LENGTH = Struct("!i")
+
+logger = getLogger(__name__)
+
+
+def dump_fields(model):
+    fields = {u"id": model.id}
+    for name, field in model.fields.items():
+        if name == "sock":
+            continue
+        value = getattr(model, name)
+        if field.dump is dump_datetime and value is not None:
+            value = dump_datetime(value)
+        fields[name] = value
+    return fields
+
+
+def load_fields(cls, fields):
+    fields = dict((str(name), value) for name, value in fields.items())
+    for name, field in cls.fields.items():
+        if field.dump is dump_datetime and fields.get(name) is not None:
+            fields[name] = load_datetime(fields[name])
+    return fields
+
+
+def encode(data):
+    return b2a_base64(data).decode("ascii")
+
+
+def decode(data):
+    return a2b_base64(data.encode("ascii"))
+
+
+def capture(server):
+    """Return the state of server and its connections
+
+    ``server`` is the :class:`charla.server.Server` component.
+    """
+
+    transport = server.transport
+
+    users = []
+    for user in connections:
+        if not user.local:
+            continue
+
+        try:
+            fd = user.sock.fileno()
+        except SocketError:
+            # Closed but not yet reaped
+            continue
+
+        buffer = server.buffers.buffers.get(user.sock)
+
+        users.append({
+            u"fd": fd,
+            u"family": user.sock.family,
+            u"fields": dump_fields(user),
+            u"recvq": encode(bytes(buffer or b"")),
+            u"truncated": bool(buffer is not None and buffer.truncated),
+            u"sendq": encode(b"".join(transport._buffers.get(user.sock, ()))),
+        })
+
+    return {
+        u"listener": {u"fd": transport._sock.fileno(), u"family": transport._sock.family},
+        u"users": users,
+        u"channels": [
+            {
+                u"fields": dump_fields(channel),
+                u"members": [
+                    [user.id, member.modes] for user, member in channel.members.items()
+                    if user.local
+                ],
+            }
+            for channel in channels
+        ],
+        u"maxusers": connections.maxusers,
+    }
+
+
+def save(state, filename):
+    with open(filename, "w") as f:
+        json.dump(state, f)
+
+
+def load(filename):
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+def inherit(state):
+    """Arrange for the sockets of state, and only those, to survive ``exec``"""
+
+    keep = set([state[u"listener"][u"fd"]])
+    keep.update(user[u"fd"] for user in state[u"users"])
+
+    try:
+        fds = [int(fd) for fd in os.listdir("/proc/self/fd")]
+    except OSError:
+        fds = range(3, 1024)
+
+    for fd in fds:
+        if fd < 3:
+            continue
+        try:
+            flags = fcntl(fd, F_GETFD)
+        except (IOError, OSError):
+            continue
+        if fd in keep:
+            fcntl(fd, F_SETFD, flags & ~FD_CLOEXEC)
+        else:
+            fcntl(fd, F_SETFD, flags | FD_CLOEXEC)
+
+
+def adopt(entry):
+    # fromfd returns a bare _socket.socket on Python 2
+    sock = socket(_sock=fromfd(entry[u"fd"], entry[u"family"], SOCK_STREAM))
+    os.close(entry[u"fd"])
+    sock.setblocking(False)
+    return sock
+
+
+def restore(state):
+    """Recreate the users and channels of state
+
+    Returns the listening socket and a list of ``(sock, recvq,
+    truncated, sendq, signon)`` of the client connections for the
+    server to resume serving, where signon is ``True`` for registered
+    users whose signon was held up by a host lookup.
+    """
+
+    listener = adopt(state[u"listener"])
+
+    clients = []
+    for entry in state[u"users"]:
+        sock = adopt(entry)
+
+        user = User(sock=sock, **load_fields(User, entry[u"fields"]))
+
+        # Lookups in progress were lost with the old process
+        pending = user.hostname is None
+        if pending:
+            user.hostname = normalize(user.host)
+
+        user.save()
+
+        clients.append((
+            sock, decode(entry[u"recvq"]), entry[u"truncated"], decode(entry[u"sendq"]),
+            pending and user.registered,
+        ))
+
+    for entry in state[u"channels"]:
+        channel = Channel(**load_fields(Channel, entry[u"fields"]))
+        for id, modes in entry[u"members"]:
+            user = connections.ids.get(id)
+            if user is not None:
+                channel.join(user, modes)
+
+    for cls, models in ((User, connections), (Channel, channels)):
+        cls.ids = count(max([model.id for model in models] or [0]) + 1)
+
+    connections.maxusers = max(connections.maxusers, state[u"maxusers"])
+
+    return listener, clients
+
+
+def pack_settings(settings):
+    """Encode a list of :class:`~charla.models.Settings`"""
+
+    chunks = [HEADER.pack(MAGIC, VERSION, len(settings))]
+    for entry in settings:
+        name = entry.name.encode("utf-8")
+        chunks.append(RECORD.pack(entry.flags, timegm(entry.created.utctimetuple()), len(name)))
+        chunks.append(name)
+        if entry.topic is None:
+            chunks.append(LENGTH.pack(-1))
+        else:
+            topic = entry.topic.encode("utf-8")
+            chunks.append(LENGTH.pack(len(topic)))
+            chunks.append(topic)
+    return b"".join(chunks)
+
+
+def unpack_settings(data, budget=None, clock=time):
+    """Decode settings encoded by :func:`pack_settings`
+
+    If budget is given decoding stops once it has taken that many
+    seconds, returning what was decoded so far. Raises ValueError if
+    data is not a valid snapshot.
+    """
+
+    start = clock()
+
+    try:
+        magic, version, n = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a version {0} snapshot".format(VERSION))
+
+        settings, offset = [], HEADER.size
+        for i in range(n):
+            if budget is not None and i and not i % 1024 and clock() - start > budget:
+                logger.warn("Snapshot load over budget, {0} of {1} channels restored".format(i, n))
+                break
+
+            flags, created, size = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            name = data[offset:offset + size]
+            if len(name) != size:
+                raise ValueError("Truncated snapshot")
+            name = name.decode("utf-8")
+            offset += size
+
+            size, = LENGTH.unpack_from(data, offset)
+            offset += LENGTH.size
+            if size < 0:
+                topic = None
+            else:
+                topic = data[offset:offset + size]
+                if len(topic) != size:
+                    raise ValueError("Truncated snapshot")
+                topic = topic.decode("utf-8")
+                offset += size
+
+            settings.append(Settings(name, flags, topic, datetime.utcfromtimestamp(created)))
+    except (StructError, UnicodeError) as e:
+        raise ValueError(e)
+
+    return settings
+
+
+def write(filename, settings):
+    """Write settings to filename atomically
+
+    Safe to call from a background thread.
+    """
+
+    start = time()
+
+    data = pack_settings(settings)
+
+    tmp = "{0}.tmp".format(filename)
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, filename)
+    except (IOError, OSError) as e:
+        logger.error("Cannot write snapshot {0}: {1}".format(filename, e))
+        return
+
+    metrics.observe("snapshot.write", time() - start)
+
+
+def read(filename, budget=None):
+    """Read the settings written to filename
+
+    Returns an empty list if there is no usable snapshot.
+    """
+
+    start = time()
+
+    try:
+        with open(filename, "rb") as f:
+            settings = unpack_settings(f.read(), budget)
+    except IOError:
+        return []
+    except ValueError as e:
+        logger.error("Ignoring snapshot {0}: {1}".format(filename, e))
+        return []
+
+    logger.info("Loaded {0} channel(s) from {1} in {2:.3f}s".format(
+        len(settings), filename, time() - start)
+    )
+
+    return settings
@@ -0,0 +1,331 @@
+"""Store Module
+
+Mirrors live channel state to Redis. The in-process tables in
+:mod:`charla.models` are authoritative; the store only writes.
+
+Nothing is written as it happens. Saved models and state transitions
+(JOIN, PART, KICK, QUIT) are collected during each tick of the event
+loop and written by :meth:`Store.flush` as a single ``MULTI``/``EXEC``
+pipeline, so a tick costs one round trip, a model saved several times
+is written once with only its changed fields and Redis never holds a
+half-joined user. Keys are laid out as::
+
+    charla:channels                     set of casefolded channel names
+    charla:channel:<name>               hash of name, mode flags and topic
+    charla:channel:<name>:members       hash of user id -> member modes
+    charla:user:<id>                    hash of user fields
+    charla:user:<id>:channels           set of casefolded channel names
+    charla:nicks                        hash of casefolded nick -> user id
+    charla:founders                     hash of casefolded channel name -> user id
+    charla:bus                          pub/sub channel of charla.bus
+
+In write-behind mode (see :meth:`Store.start`) the pipeline is handed
+to a background :class:`Writer` instead, so the event loop never waits
+on Redis at all.
+"""
+
+
+from time import time
+from logging import getLogger
+from threading import Thread
+from Queue import Queue, Full
+
+
+from .metrics import metrics, Histogram
+from .utils import casefold
+
+
+# Delete a hash field only if it still holds the given user id
+RELEASE = u"""
+if redis.call("hget", KEYS[1], ARGV[1]) == ARGV[2] then
+    return redis.call("hdel", KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+
+class Writer(Thread):
+    """Background thread executing queued pipelines in order
+
+    Statistics are kept here rather than in :data:`charla.metrics.metrics`
+    so the event loop only ever reads them.
+    """
+
+    daemon = True
+
+    def __init__(self, queue):
+        super(Writer, self).__init__(name="store")
+
+        self.queue = queue
+
+        self.logger = getLogger(__name__)
+
+        self.batches = 0
+        self.commands = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+    def run(self):
+        while True:
+            pipe = self.queue.get()
+            try:
+                if pipe is None:
+                    return
+
+                # execute() resets the command stack
+                commands, start = len(pipe.command_stack), time()
+                try:
+                    pipe.execute()
+                except Exception as e:
+                    self.errors += 1
+                    self.logger.error("Write failed: {0}".format(e))
+                else:
+                    self.batches += 1
+                    self.commands += commands
+                    self.latency.observe(time() - start)
+            finally:
+                self.queue.task_done()
+
+
+class Store(object):
+
+    prefix = u"charla"
+
+    def __init__(self, db=None):
+        self.db = db
+
+        # Models saved since the last flush
+        self.dirty = set()
+
+        # Pipeline of the current tick (see pipeline)
+        self.pipe = None
+
+        # Queue of pipelines pending in write-behind mode (see start)
+        self.queue = None
+        self.writer = None
+        self.maxdeferred = None
+
+    def start(self, maxsize=64, maxdeferred=10000):
+        """Enable write-behind mode
+
+        Pipelines are executed by a :class:`Writer` thread from a queue
+        of at most maxsize batches. While the queue is full further
+        writes are merged into the pending pipeline rather than blocking,
+        until it holds maxdeferred commands.
+        """
+
+        self.queue = Queue(maxsize)
+        self.maxdeferred = maxdeferred
+        self.writer = Writer(self.queue)
+        self.writer.start()
+
+        metrics.gauge("store.queue", self.queue.qsize)
+        metrics.gauge("store.batches", lambda: self.writer.batches)
+        metrics.gauge("store.commands", lambda: self.writer.commands)
+        metrics.gauge("store.errors", lambda: self.writer.errors)
+        metrics.histograms["store.write"] = self.writer.latency
+
+    def stop(self, timeout=5):
+        """Flush pending writes and wait for the writer to finish"""
+
+        if self.writer is None:
+            return
+
+        self.flush()
+
+        try:
+            if self.pipe is not None:
+                self.queue.put(self.pipe, timeout=timeout)
+                self.pipe = None
+            self.queue.put(None, timeout=timeout)
+        except Full:
+            return
+
+        self.writer.join(timeout)
+
+    def key(self, *args):
+        return u":".join((self.prefix,) + tuple(unicode(arg) for arg in args))
+
+    def channel_key(self, channel):
+        return self.key(u"channel", casefold(channel.name))
+
+    def members_key(self, channel):
+        return self.key(u"channel", casefold(channel.name), u"members")
+
+    def channels_key(self, user):
+        return self.key(u"user", user.id, u"channels")
+
+    def recover(self):
+        """Return the channel hashes a previous process left in Redis
+
+        Everything else it left under :attr:`prefix` is deleted, as no
+        client can be connected yet. Other keys are left alone.
+        """
+
+        names = self.db.smembers(self.key(u"channels"))
+
+        pipe = self.db.pipeline(transaction=False)
+        for name in names:
+            pipe.hgetall(self.key(u"channel", name.decode("utf-8")))
+        hashes = pipe.execute()
+
+        keys = list(self.db.scan_iter(match=u"{0}:*".format(self.prefix), count=1000))
+        for i in range(0, len(keys), 1000):
+            self.db.delete(*keys[i:i + 1000])
+
+        return hashes
+
+    def pipeline(self):
+        """Return the pipeline collecting writes for the current tick"""
+
+        if self.pipe is None:
+            self.pipe = self.db.pipeline(transaction=True)
+        return self.pipe
+
+    def save(self, model):
+        self.dirty.add(model)
+
+    def delete(self, model):
+        self.dirty.discard(model)
+        model.dirty = None
+        self.pipeline().delete(model.key())
+
+    def flush(self):
+        """Write everything saved since the last flush in one round trip
+
+        Called once per tick of the event loop.
+        """
+
+        if not self.dirty and self.pipe is None:
+            return
+
+        pipe = self.pipeline()
+
+        for model in self.dirty:
+            if not model.dirty:
+                continue
+
+            key = model.key()
+            fields = dict((k, v) for k, v in model.dirty.items() if v is not None)
+            empty = [k for k, v in model.dirty.items() if v is None]
+
+            if fields:
+                pipe.hmset(key, fields)
+            if empty:
+                pipe.hdel(key, *empty)
+
+            model.dirty = None
+
+        self.dirty.clear()
+
+        if self.queue is None:
+            self.pipe = None
+            pipe.execute()
+            return
+
+        try:
+            self.queue.put_nowait(pipe)
+        except Full:
+            if len(pipe.command_stack) < self.maxdeferred:
+                # Backpressure: keep batching into this pipeline until the
+                # writer catches up
+                metrics.incr("store.deferred")
+                return
+
+            # Bound the memory held by the pipeline, at the cost of
+            # stalling the event loop until the writer catches up
+            metrics.incr("store.blocked")
+            self.queue.put(pipe)
+
+        self.pipe = None
+
+    def claim(self, nick, user):
+        """Claim nick for user across all worker processes
+
+        Unlike everything else this is written immediately as it must be
+        decided before a NICK is accepted. Returns ``False`` if nick is
+        held by another user.
+        """
+
+        key, nick = self.key(u"nicks"), casefold(nick)
+        if self.db.hsetnx(key, nick, user.id):
+            return True
+        return int(self.db.hget(key, nick) or 0) == user.id
+
+    def release(self, nick, user):
+        """Release the claim of user on nick
+
+        Written immediately like :meth:`claim` so the two are applied in
+        order: a release queued behind a later claim of the same nick by
+        the same user would otherwise delete it. The claim is only
+        deleted if user still holds it.
+        """
+
+        self.db.eval(RELEASE, 1, self.key(u"nicks"), casefold(nick), user.id)
+
+    def found(self, channel, user):
+        """Record user as the founder of channel across all worker processes
+
+        Written immediately like :meth:`claim` so that only one worker
+        grants operator status to the user creating a channel. Returns
+        ``False`` if channel already has a founder other than user.
+        """
+
+        key, name = self.key(u"founders"), casefold(channel.name)
+        if self.db.hsetnx(key, name, user.id):
+            channel.founder = user.id
+            return True
+        return self.founder(channel) == user.id
+
+    def founder(self, channel):
+        """Return the id of the user who founded channel or ``0``"""
+
+        channel.founder = int(self.db.hget(self.key(u"founders"), casefold(channel.name)) or 0)
+        return channel.founder
+
+    def disband(self, channel):
+        """Release the founding of channel now it has no members"""
+
+        if channel.founder:
+            key, name = self.key(u"founders"), casefold(channel.name)
+            self.db.eval(RELEASE, 1, key, name, channel.founder)
+            channel.founder = 0
+
+    def save_member(self, member):
+        self.pipeline().hset(self.members_key(member.channel), member.user.id, member.modes)
+
+    def join(self, channel, member, new=False):
+        """Record member joining channel, creating channel if it is new"""
+
+        pipe = self.pipeline()
+
+        if new:
+            self.save(channel)
+            pipe.sadd(self.key(u"channels"), casefold(channel.name))
+
+        pipe.hset(self.members_key(channel), member.user.id, member.modes)
+        pipe.sadd(self.channels_key(member.user), casefold(channel.name))
+
+    def part(self, channel, user):
+        """Record user leaving channel, deleting channel if now empty"""
+
+        pipe = self.pipeline()
+
+        pipe.hdel(self.members_key(channel), user.id)
+        pipe.srem(self.channels_key(user), casefold(channel.name))
+
+        if not channel.members:
+            self.delete(channel)
+            pipe.delete(self.members_key(channel))
+            pipe.srem(self.key(u"channels"), casefold(channel.name))
+
+    def quit(self, user, channels):
+        """Record user leaving all of the given channels"""
+
+        for channel in channels:
+            self.part(channel, user)
+
+        self.pipeline().delete(self.channels_key(user))
+
+
+store = Store()
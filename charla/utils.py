@@ -1,13 +1,49 @@
 """Utilities Module"""
 
 
+import re
 from time import sleep
+from string import ascii_lowercase, ascii_uppercase
 from socket import AF_INET, SOCK_STREAM, socket
 
 
+# RFC 1459 casemapping: []\~ are the uppercase forms of {}|^
+CASEMAPPING = u"rfc1459"
+
+CASEMAP = dict(
+    (ord(upper), ord(lower))
+    for upper, lower in zip(ascii_uppercase + u"[]\\~", ascii_lowercase + u"{}|^")
+)
+
+
 def waitfor(address, port, timeout=10):
     sock = socket(AF_INET, SOCK_STREAM)
     counter = timeout
     while not sock.connect_ex((address, port)) == 0 and counter:
         sleep(1)
         counter -= 1
+
+
+def casefold(s):
+    """Fold s to lowercase using the RFC 1459 casemapping
+
+    Used to compare and index nicks and channel names.
+    """
+
+    return unicode(s).translate(CASEMAP)
+
+
+def compile_mask(mask):
+    """Compile an IRC mask into a case insensitive regular expression
+
+    Only ``*`` (any number of characters) and ``?`` (any single character)
+    are wildcards; everything else, including ``[``, matches literally.
+    The returned pattern is meant to be matched against casefolded names.
+    """
+
+    pattern = u"".join(
+        u".*" if c == u"*" else u"." if c == u"?" else re.escape(c)
+        for c in casefold(mask)
+    )
+
+    return re.compile(u"{0}$".format(pattern), re.DOTALL)
@@ -0,0 +1,145 @@
+"""Wheel Module
+
+Hierarchical timing wheel scheduling the server's per-connection timers.
+
+Registering a circuits ``Timer`` per connection costs a component and an
+event every time it is checked. The wheel instead keeps timers in
+buckets of ``slots`` ticks per level, each level covering ``slots``
+times the span of the one below it, so that scheduling and cancelling a
+timer is O(1) however many are pending and advancing the clock only
+visits the timers that are due. Timers in a higher level are moved down
+("cascaded") as the clock reaches their bucket.
+
+The wheel is advanced once per iteration of the event loop by
+:class:`charla.core.Core`, which also has the loop wait no longer than
+the next tick for I/O.
+"""
+
+
+from time import time
+from math import ceil
+from logging import getLogger
+
+
+logger = getLogger(__name__)
+
+
+class Timer(object):
+    """Pending call scheduled by :meth:`Wheel.schedule`"""
+
+    __slots__ = ("expires", "callback", "args", "bucket",)
+
+    def __init__(self, expires, callback, args):
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+
+        # Set of the bucket this timer is in, None once fired or cancelled
+        self.bucket = None
+
+    @property
+    def pending(self):
+        return self.bucket is not None
+
+    def cancel(self):
+        if self.bucket is not None:
+            self.bucket.discard(self)
+            self.bucket = None
+
+
+class Wheel(object):
+    """Timing wheel
+
+    ``resolution`` is the length of a tick in seconds, timers fire on
+    the first tick at or after they are due. ``slots`` must be a power of
+    two. Timers due further ahead than ``slots ** levels`` ticks are held
+    in the last level until they come into range.
+    """
+
+    def __init__(self, resolution=1.0, slots=64, levels=4, clock=time):
+        self.resolution = resolution
+        self.slots = slots
+        self.levels = levels
+        self.clock = clock
+
+        self.bits = slots.bit_length() - 1
+        self.mask = slots - 1
+        self.span = slots ** levels
+
+        self.wheels = [[set() for _ in range(slots)] for _ in range(levels)]
+
+        self.epoch = clock()
+        self.tick = 0
+
+    def __len__(self):
+        return sum(len(bucket) for wheel in self.wheels for bucket in wheel)
+
+    def ticks(self, now):
+        return int((now - self.epoch) / self.resolution)
+
+    def place(self, timer):
+        delta = timer.expires - self.tick
+        expires = timer.expires if delta < self.span else self.tick + self.span - 1
+
+        level = 0
+        while level < self.levels - 1 and max(delta, 0) >= 1 << (self.bits * (level + 1)):
+            level += 1
+
+        bucket = self.wheels[level][(expires >> (self.bits * level)) & self.mask]
+        bucket.add(timer)
+        timer.bucket = bucket
+
+    def schedule(self, delay, callback, *args):
+        """Call ``callback(*args)`` in delay seconds
+
+        Returns a :class:`Timer` that can be cancelled.
+        """
+
+        # Never due before the next tick, the current one may be firing
+        expires = int(ceil((self.clock() + delay - self.epoch) / self.resolution))
+        timer = Timer(max(expires, self.tick + 1), callback, args)
+        self.place(timer)
+        return timer
+
+    def timeout(self):
+        """Return the seconds until the next tick is due"""
+
+        return max(self.epoch + (self.tick + 1) * self.resolution - self.clock(), 0)
+
+    def advance(self, now=None):
+        """Fire every timer due by now, returning how many fired"""
+
+        target = self.ticks(self.clock() if now is None else now)
+
+        fired = 0
+        while self.tick < target:
+            self.tick += 1
+
+            # Bring the timers of higher levels whose bucket has come
+            # round down to the levels below, highest first
+            level = 1
+            while level < self.levels and not self.tick & ((1 << (self.bits * level)) - 1):
+                level += 1
+            for level in range(level - 1, 0, -1):
+                index = (self.tick >> (self.bits * level)) & self.mask
+                bucket, self.wheels[level][index] = self.wheels[level][index], set()
+                for timer in bucket:
+                    self.place(timer)
+
+            index = self.tick & self.mask
+            bucket, self.wheels[0][index] = self.wheels[0][index], set()
+            for timer in list(bucket):
+                if timer.bucket is not bucket:
+                    # Cancelled by the callback of another timer
+                    continue
+                timer.bucket = None
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    logger.exception("Error in timer {0!r}".format(timer.callback))
+                fired += 1
+
+        return fired
+
+
+timers = Wheel()
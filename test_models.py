@@ -6,29 +6,25 @@ from __future__ import print_function
 from socket import socket
 
 
-from redisco import connection_setup, get_client
+from redis import StrictRedis
 
 
+from charla.store import store
 from charla.models import User, Channel
 
 
-connection_setup()
-db = get_client()
+db = StrictRedis()
 db.flushall()
 
+store.db = db
+
 user = User(sock=socket(), nick="foo")
 user.save()
-channel = Channel(name="#foo")
-channel.save()
-
+channel = Channel("#foo")
 
-channel.users.append(user)
-channel.save()
-
-user.channels.append(channel)
-user.save()
 
-x = Channel.objects.filter(name="#foo").first()
+channel.join(user)
+store.flush()
 
 print()
-print(Channel.objects.filter(name="#foo").first().users)
+print(channel.members)
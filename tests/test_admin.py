@@ -0,0 +1,29 @@
+"""Test Admin"""
+
+
+from collections import namedtuple
+
+
+from charla.plugins.admin import normalize_mask, Admin
+
+
+User = namedtuple("User", ("prefix",))
+
+
+def test_normalize_mask():
+    assert normalize_mask(u"*!prologic@::ffff:127.0.0.1") == u"*!prologic@127.0.0.1"
+    assert normalize_mask(u"*!prologic@0:0::1") == u"*!prologic@::1"
+    assert normalize_mask(u"*!prologic@*.example.com") == u"*!prologic@*.example.com"
+
+
+def test_oline(monkeypatch):
+    admin = Admin(None, {}, None)
+
+    assert admin.oline(User(u"test!prologic@127.0.0.1")) == (u"prologic", u"test")
+    assert admin.oline(User(u"test!prologic@10.0.0.1")) is None
+
+    # Masks written for IPv4-mapped addresses still match
+    monkeypatch.setattr(Admin, "olines", {u"*!prologic@::ffff:127.0.0.1": (u"prologic", u"test")})
+    admin = Admin(None, {}, None)
+
+    assert admin.oline(User(u"test!prologic@127.0.0.1")) == (u"prologic", u"test")
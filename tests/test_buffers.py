@@ -0,0 +1,51 @@
+"""Test Buffers"""
+
+
+from charla.buffers import Buffers
+
+
+def test_split():
+    buffers = Buffers()
+    buffer = buffers.get(1)
+
+    lines, buffer = buffers.split(b"NICK test\r\nUSER test", buffer)
+
+    assert lines == [b"NICK test"]
+    assert buffer == b"USER test"
+
+    lines, buffer = buffers.split(b" * * :Test\n\r\n", buffer)
+
+    assert lines == [b"USER test * * :Test"]
+    assert buffer == b""
+
+
+def test_split_long_line():
+    buffers = Buffers(16)
+    buffer = buffers.get(1)
+
+    lines, buffer = buffers.split(b"PRIVMSG #test :hello", buffer)
+
+    assert lines == []
+    assert len(buffer) == 14
+
+    lines, buffer = buffers.split(b" world", buffer)
+
+    assert lines == []
+    assert len(buffer) == 14
+
+    lines, buffer = buffers.split(b"!\r\nPING :test\r\n", buffer)
+
+    assert lines == [b"PRIVMSG #test ", b"PING :test"]
+    assert buffer == b""
+
+
+def test_free():
+    buffers = Buffers()
+    buffer = buffers.get(1)
+
+    buffers.split(b"PING", buffer)
+    assert buffers.size == 4
+
+    buffers.free(1)
+    assert 1 not in buffers
+    assert buffers.size == 0
@@ -0,0 +1,99 @@
+"""Test Bus"""
+
+
+from time import sleep
+
+
+import pytest
+
+from circuits import handler, Component
+
+from circuits.core.manager import TIMEOUT
+
+
+from charla.bus import Bus
+from charla.store import store
+from charla.models import Remote, User
+
+
+redis = pytest.importorskip("redis")
+
+
+class Recorder(Component):
+
+    channel = "server"
+
+    def init(self):
+        self.events = []
+
+    @handler("join", "nick", "privmsg")
+    def _on_command(self, event, sock, source, *args):
+        self.events.append((event.name, args))
+
+    def wait(self, n, timeout=6.0):
+        for i in range(int(timeout / TIMEOUT)):
+            if len(self.events) >= n:
+                return True
+            sleep(TIMEOUT)
+
+
+class Local(Bus):
+
+    channel = "bus0"
+
+
+class Other(Bus):
+
+    channel = "bus1"
+
+
+@pytest.fixture
+def db(request):
+    db = redis.StrictRedis()
+    try:
+        db.ping()
+    except redis.ConnectionError:
+        pytest.skip("Redis is not running")
+
+    saved, store.db = store.db, db
+
+    def finalizer():
+        store.db = saved
+
+    request.addfinalizer(finalizer)
+
+    return db
+
+
+def test_relay(manager, db):
+    recorder = Recorder().register(manager)
+
+    # Two workers on the same Redis, each on its own channel as they
+    # would be in separate processes
+    local = Local(db, 0).register(manager)
+    other = Other(db, 1).register(manager)
+
+    # A user of worker 0 as worker 1 sees it
+    user = User(
+        sock=Remote(0), nick=u"test", username=u"test", hostname=u"localhost",
+        registered=True
+    )
+    user.save()
+
+    try:
+        # Only the commands of COMMANDS are run for other workers
+        local.relay(user, "nick", [u"other"])
+        local.relay(user, "join", [u"#test"])
+        local.relay(user, "privmsg", [u"#test", u"Hello World!"])
+        local.flush()
+        store.flush()
+
+        assert recorder.wait(2)
+        assert recorder.events == [
+            ("join", (u"#test",)),
+            ("privmsg", (u"#test", u"Hello World!")),
+        ]
+    finally:
+        user.delete()
+        for component in (other, local, recorder):
+            component.unregister()
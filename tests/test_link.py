@@ -0,0 +1,153 @@
+"""Test Link"""
+
+
+import json
+from calendar import timegm
+from datetime import datetime, timedelta
+
+
+import pytest
+
+
+from charla.store import store
+from charla.plugins.link import compare_digest, Link
+from charla.models import channels, connections, servers, Channel, User
+
+from .test_store import Database
+
+
+class Server(object):
+
+    host = u"irc.local"
+    info = u"Local"
+
+
+class Transport(object):
+
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    def send(self, data):
+        self.sent.extend(json.loads(line) for line in data.splitlines())
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def db(request):
+    saved, store.db = store.db, Database()
+
+    def finalizer():
+        for user in list(connections):
+            user.quit()
+            user.delete()
+        for peer in list(servers):
+            servers.remove(peer)
+        store.dirty.clear()
+        store.pipe = None
+        store.db = saved
+
+    request.addfinalizer(finalizer)
+
+    return store.db
+
+
+def link(password=u"secret"):
+    plugin = Link(Server(), {"linkpassword": password, "workers": 1}, None)
+
+    plugin.events = []
+    plugin.fire = lambda event, *channels: plugin.events.append(event)
+
+    transport = Transport()
+    plugin.opened(transport, transport.send, transport.close, False)
+
+    return plugin, transport
+
+
+def hello(password):
+    return {u"t": u"server", u"name": u"irc.remote", u"info": u"Remote", u"password": password}
+
+
+def receive(plugin, transport, *messages):
+    plugin.received(transport, b"".join(json.dumps(message) + "\n" for message in messages))
+
+
+def test_password(db):
+    plugin, transport = link()
+    receive(plugin, transport, hello(u"wrong"))
+
+    assert transport.sent == [{u"t": u"error", u"reason": u"Bad password"}]
+    assert transport.closed
+
+    plugin, transport = link()
+    receive(plugin, transport, hello(u"secret"))
+
+    assert transport.sent[0][u"t"] == u"server"
+    assert not transport.closed
+    assert plugin.sessions[transport].name == u"irc.remote"
+
+
+def test_compare_digest():
+    assert compare_digest(b"secret", b"secret")
+    assert not compare_digest(b"secret", b"secreT")
+    assert not compare_digest(b"secret", b"secrets")
+
+
+def test_no_password(db):
+    plugin, transport = link(None)
+    receive(plugin, transport, hello(None))
+
+    assert transport.sent == [{u"t": u"error", u"reason": u"Bad password"}]
+    assert transport.closed
+
+
+def test_user(db):
+    plugin, transport = link()
+    receive(plugin, transport, hello(u"secret"), {
+        u"t": u"user", u"uid": u"irc.remote/1", u"ts": 1, u"origin": u"irc.remote",
+        u"nick": u"bob", u"username": u"bob", u"hostname": u"localhost",
+        u"realname": u"Bob", u"server": u"localhost", u"flags": 0, u"away": None,
+    })
+
+    user = connections.find(u"bob")
+    assert user.origin == u"irc.remote"
+    assert user.server == u"localhost"
+
+    receive(plugin, transport, {u"t": u"cmd", u"uid": u"irc.remote/1", u"c": u"join", u"a": [u"#test"]})
+
+    assert [event.args[2:] for event in plugin.events if event.name == "join"] == [[u"#test"]]
+
+    # Only the commands of COMMANDS are run for linked servers
+    receive(plugin, transport, {u"t": u"cmd", u"uid": u"irc.remote/1", u"c": u"oper", u"a": [u"a", u"b"]})
+
+    assert not [event for event in plugin.events if event.name == "oper"]
+
+
+def test_merge(db):
+    plugin, transport = link()
+    receive(plugin, transport, hello(u"secret"))
+
+    user = User(sock=object(), nick=u"alice", username=u"alice", hostname=u"localhost", registered=True)
+    user.save()
+
+    channel = Channel(u"#test", flags=Channel.NOEXTERNAL, topic=u"Mine")
+    channel.join(user, u"o")
+
+    # The other side's channel is older
+    ts = timegm((datetime.utcnow() - timedelta(hours=1)).utctimetuple())
+    receive(plugin, transport, {
+        u"t": u"channel", u"name": u"#test", u"ts": ts, u"flags": Channel.TOPICLOCK,
+        u"topic": u"Theirs", u"members": [],
+    })
+
+    assert channels.get(u"#test") is channel
+    assert channel.flags == Channel.TOPICLOCK
+    assert not channel.is_operator(user)
+
+    messages = [event.args[1] for event in plugin.events if event.name == "broadcast"]
+    assert [(message.command, message.args) for message in messages] == [
+        (u"MODE", [u"#test", u"-n+t-o", u"alice"]),
+        (u"TOPIC", [u"#test", u"Theirs"]),
+    ]
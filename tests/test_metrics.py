@@ -0,0 +1,51 @@
+"""Test Metrics"""
+
+
+from datetime import datetime, timedelta
+
+
+from charla.models import Remote, User
+from charla.plugins import welcome
+from charla.plugins.welcome import Welcome
+from charla.metrics import Metrics, COUNTS
+
+
+def test_report():
+    metrics = Metrics()
+
+    metrics.incr("fanout.lines")
+    for n in (1, 3, 3, 200000):
+        metrics.observe("fanout.size", n, COUNTS)
+    metrics.observe("fanout.time", 0.002)
+
+    assert list(metrics.report()) == [
+        u"fanout.lines: 1",
+        u"fanout.size: count=4 avg=50001.8 max=200000 <=1:1 <=5:2 >100000:1",
+        u"fanout.time: count=1 avg=0.002 max=0.002 <=0.005:1",
+    ]
+
+
+def test_registration(monkeypatch):
+    monkeypatch.setattr(welcome, "metrics", Metrics())
+
+    class Server(object):
+        name = u"charla"
+        version = u"0.0.0"
+        network = host = created = u"test"
+
+    plugin = Welcome(Server(), {}, None)
+    plugin.fire = lambda event, *channels: None
+
+    # Remote so that nothing is written to the store
+    user = User(sock=Remote(0), nick=u"test", registered=True)
+    user.signon = datetime.utcnow() - timedelta(seconds=5.5)
+    user.save()
+
+    try:
+        next(plugin.signon(user.sock, user.source))
+    finally:
+        user.delete()
+
+    line, = welcome.metrics.report()
+    assert line.startswith(u"registration.time: count=1")
+    assert line.endswith(u"<=6:1")
@@ -0,0 +1,53 @@
+"""Test Mode"""
+
+
+from circuits.protocols.irc import Message
+
+
+from charla.plugins.mode import channel_modes, format_modes, parse_modes, MAXMODES
+
+
+def test_parse_modes():
+    assert list(parse_modes([u"+nt"], channel_modes)) == [
+        (u"+", u"n", None),
+        (u"+", u"t", None),
+    ]
+
+    assert list(parse_modes([u"+ov-m", u"bob", u"carol"], channel_modes)) == [
+        (u"+", u"o", u"bob"),
+        (u"+", u"v", u"carol"),
+        (u"-", u"m", None),
+    ]
+
+    assert list(parse_modes([u"+o", u"bob", u"-v", u"carol"], channel_modes)) == [
+        (u"+", u"o", u"bob"),
+        (u"-", u"v", u"carol"),
+    ]
+
+    # Missing sign, missing parameter and unknown mode
+    assert list(parse_modes([u"ox", u"bob", u"v"], channel_modes)) == [
+        (u"+", u"o", u"bob"),
+        (None, u"x", None),
+        (u"+", u"v", None),
+    ]
+
+
+def test_parse_modes_maxmodes():
+    nicks = [u"user{0}".format(i) for i in range(MAXMODES + 2)]
+    changes = list(parse_modes([u"+" + u"o" * len(nicks)] + nicks, channel_modes))
+
+    assert [param for op, mode, param in changes] == nicks[:MAXMODES]
+
+
+def test_format_modes():
+    assert format_modes([]) == (u"", [])
+
+    changes = [
+        (u"+", u"o", u"bob"), (u"+", u"v", u"carol"), (u"-", u"n", None), (u"-", u"v", u"dave"),
+    ]
+    modes, params = format_modes(changes)
+
+    assert (modes, params) == (u"+ov-nv", [u"bob", u"carol", u"dave"])
+
+    message = Message(u"MODE", u"#test", modes, *params)
+    assert bytes(message) == b"MODE #test +ov-nv bob carol dave\r\n"
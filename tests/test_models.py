@@ -0,0 +1,40 @@
+"""Test Models"""
+
+
+from charla.models import Channel, Channels
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_saved():
+    clock = Clock()
+    table = Channels(ttl=60, limit=3, clock=clock)
+
+    for i in range(5):
+        channel = Channel(u"#{0}".format(i), topic=u"Topic {0}".format(i))
+        table.update(channel)
+        table.remove(channel)
+
+    # Only the most recently emptied channels are kept
+    assert sorted(entry.name for entry in table.settings()) == [u"#2", u"#3", u"#4"]
+
+    clock.now = 30
+    channel = Channel(u"#2")
+    table.update(channel)
+    assert channel.topic == u"Topic 2"
+
+    # Expired settings are not given to a new channel of the same name
+    clock.now = 61
+    channel = Channel(u"#3")
+    table.update(channel)
+    assert channel.topic is None
+
+    # Leaving only the channel in use
+    assert [entry.name for entry in table.settings()] == [u"#2"]
@@ -0,0 +1,36 @@
+"""Test Processor"""
+
+
+from circuits.protocols.irc import Message
+
+
+from charla.context import Context
+from charla.plugins.processor import Processor
+
+
+class Server(object):
+
+    host = u"irc.local"
+
+
+class User(object):
+
+    def __init__(self, nick):
+        self.nick = nick
+
+
+def test_reply():
+    plugin = Processor(Server(), {"workers": 1}, None)
+
+    events = []
+    plugin.fire = lambda event, *channels: events.append(event)
+
+    message = Message(u"NOTICE", u"Hello", add_nick=True)
+    for nick in (u"alice", u"bob"):
+        plugin.reply(nick, message, Context(nick, User(nick)))
+
+    assert [event.args[1] for event in events] == [
+        b":irc.local NOTICE alice Hello\r\n",
+        b":irc.local NOTICE bob Hello\r\n",
+    ]
+    assert message.args == [u"Hello"]
@@ -0,0 +1,194 @@
+"""Test Resolver"""
+
+
+from struct import pack, unpack_from
+from threading import Thread
+from socket import socket, inet_pton, AF_INET, SOCK_DGRAM
+
+
+import pytest
+
+
+from charla.resolver import A, PTR, NXDOMAIN
+from charla.resolver import decode_name, encode_name, normalize, reverse_name, valid_hostname
+from charla.resolver import Cache, Resolver
+
+
+RECORDS = {
+    ("1.0.0.127.in-addr.arpa", PTR): [u"localhost.test"],
+    ("localhost.test", A): [u"127.0.0.1"],
+    ("2.0.0.127.in-addr.arpa", PTR): [u"spoofed.test"],
+    ("spoofed.test", A): [u"10.0.0.1"],
+    ("4.0.0.127.in-addr.arpa", PTR): [u"slow.test"],
+    ("6.0.0.127.in-addr.arpa", PTR): [u"evil\r\nQUIT.test"],
+    ("evil\r\nQUIT.test", A): [u"127.0.0.6"],
+}
+
+
+def answer(data):
+    """Answer a query from RECORDS
+
+    Returns None for names ending in slow.test so they time out.
+    """
+
+    id, = unpack_from("!H", data)
+    name, offset = decode_name(data, 12)
+    type, _ = unpack_from("!HH", data, offset)
+
+    if name.endswith("slow.test"):
+        return
+
+    values = RECORDS.get((name, type), [])
+    rcode = 0 if values else NXDOMAIN
+
+    response = pack("!HHHHHH", id, 0x8180 | rcode, 1, len(values), 0, 0)
+    response += data[12:offset + 4]
+
+    for value in values:
+        if type == A:
+            rdata = inet_pton(AF_INET, value)
+        else:
+            rdata = encode_name(value)
+        response += encode_name(name) + pack("!HHIH", type, 1, 300, len(rdata)) + rdata
+
+    return response
+
+
+class Nameserver(Thread):
+    """Stand-in nameserver answering from RECORDS"""
+
+    daemon = True
+
+    def __init__(self):
+        super(Nameserver, self).__init__()
+
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.address = self.sock.getsockname()
+
+        self.queries = 0
+
+    def run(self):
+        while True:
+            data, address = self.sock.recvfrom(512)
+            self.queries += 1
+            response = answer(data)
+            if response is not None:
+                self.sock.sendto(response, address)
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def nameserver():
+    nameserver = Nameserver()
+    nameserver.start()
+    return nameserver
+
+
+def resolve(resolver, sock, results, n):
+    while len(results) < n and resolver.queries:
+        resolver.receive(sock.recv(512))
+
+
+def test_normalize():
+    assert normalize("::ffff:127.0.0.1") == "127.0.0.1"
+    assert normalize("fe80:0::1%eth0") == "fe80::1"
+
+
+def test_reverse_name():
+    assert reverse_name("127.0.0.1") == "1.0.0.127.in-addr.arpa"
+    assert reverse_name("::1") == "1.0." + "0." * 30 + "ip6.arpa"
+
+
+def test_valid_hostname():
+    assert valid_hostname(u"host-1.example.com")
+    assert not valid_hostname(u"")
+    assert not valid_hostname(u"evil\r\nQUIT")
+    assert not valid_hostname(u"a!b@c")
+    assert not valid_hostname(u"::1")
+    assert not valid_hostname(u"a..b")
+    assert not valid_hostname(u"a" * 64)
+    assert not valid_hostname(u".".join([u"a" * 63] * 4))
+
+
+def test_cache():
+    clock = Clock()
+    cache = Cache(2, clock)
+
+    cache.set("a", 1, 10)
+    cache.set("b", None, 10)
+
+    assert cache.get("b", "missing") is None
+    assert cache.get("a") == 1
+
+    # b is now the least recently used
+    cache.set("c", 3, 10)
+    assert cache.get("b", "missing") == "missing"
+    assert cache.get("a") == 1
+
+    clock.now = 10
+    assert cache.get("a") is None
+
+
+def test_lookup(nameserver):
+    sock = socket(AF_INET, SOCK_DGRAM)
+    sock.settimeout(5)
+
+    resolver = Resolver(lambda data: sock.sendto(data, nameserver.address))
+
+    results = []
+    resolver.lookup("127.0.0.1", results.append)
+    resolver.lookup("::ffff:127.0.0.1", results.append)
+    resolver.lookup("127.0.0.2", results.append)
+    resolver.lookup("127.0.0.3", results.append)
+    resolver.lookup("127.0.0.6", results.append)
+
+    resolve(resolver, sock, results, 5)
+
+    assert results.count(u"localhost.test") == 2
+    assert results.count(None) == 3
+
+    # Both lookups of 127.0.0.1 shared one PTR and one A query, the
+    # invalid name of 127.0.0.6 was never looked up
+    queries = nameserver.queries
+    assert queries == 6
+
+    # Results including failures are cached
+    resolver.lookup("127.0.0.1", results.append)
+    resolver.lookup("127.0.0.3", results.append)
+    assert results[-2:] == [u"localhost.test", None]
+    assert nameserver.queries == queries
+
+
+def test_timeout(nameserver):
+    sock = socket(AF_INET, SOCK_DGRAM)
+    clock = Clock()
+
+    resolver = Resolver(
+        lambda data: sock.sendto(data, nameserver.address),
+        timeout=5, maxlookups=1, clock=clock
+    )
+
+    results = []
+    resolver.lookup("127.0.0.4", results.append)
+    resolver.lookup("127.0.0.5", results.append)
+
+    # Only one lookup may be in progress at a time
+    assert len(resolver.queries) == 1
+
+    clock.now = 5
+    resolver.expire()
+
+    assert results == [None]
+    assert len(resolver.queries) == 1
+
+    # Timeouts are not cached
+    assert resolver.cache.get("127.0.0.4", "missing") == "missing"
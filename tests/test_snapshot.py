@@ -0,0 +1,65 @@
+"""Test Snapshot"""
+
+
+import os
+from datetime import datetime
+from socket import socket, socketpair
+
+
+import pytest
+
+
+from charla.models import Settings
+from charla.snapshot import adopt, pack_settings, unpack_settings
+
+
+class Clock(object):
+
+    def __init__(self, step):
+        self.now = 0
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+def test_settings():
+    created = datetime(2014, 8, 16, 12, 0, 0)
+
+    data = pack_settings([
+        Settings(u"#charla", 3, u"Welcome \u263a", created),
+        Settings(u"#test", 1, None, created),
+    ])
+
+    settings = unpack_settings(data)
+
+    assert [(entry.name, entry.flags, entry.topic, entry.created) for entry in settings] == [
+        (u"#charla", 3, u"Welcome \u263a", created),
+        (u"#test", 1, None, created),
+    ]
+
+    with pytest.raises(ValueError):
+        unpack_settings(data[:-1])
+
+
+def test_budget():
+    created = datetime(2014, 8, 16, 12, 0, 0)
+    data = pack_settings([Settings(u"#{0}".format(i), 1, None, created) for i in range(4096)])
+
+    # Every check of the clock is over budget
+    assert len(unpack_settings(data, budget=0.5, clock=Clock(1))) == 1024
+    assert len(unpack_settings(data, budget=10, clock=Clock(0))) == 4096
+
+
+def test_adopt():
+    a, b = socketpair()
+
+    sock = adopt({u"fd": os.dup(a.fileno()), u"family": a.family})
+    a.close()
+
+    # Usable wherever circuits expects a socket
+    assert isinstance(sock, socket)
+
+    b.send(b"test")
+    assert sock.recv(4) == b"test"
@@ -0,0 +1,172 @@
+"""Test Store"""
+
+
+from Queue import Queue
+from threading import Timer
+
+
+import pytest
+
+
+from charla.store import Store
+from charla.models import Channel
+
+
+class Pipeline(object):
+
+    def __init__(self, db):
+        self.db = db
+        self.command_stack = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.command_stack.append((name,) + args)
+
+    def execute(self):
+        # As redis-py, which resets the pipeline once executed
+        self.db.executed.append(self.command_stack)
+        self.command_stack = []
+
+
+class Database(object):
+
+    def __init__(self):
+        self.executed = []
+
+    def pipeline(self, transaction=True):
+        return Pipeline(self)
+
+
+class Model(object):
+
+    def __init__(self, id):
+        self.id = id
+        self.dirty = {}
+
+    def key(self):
+        return u"test:{0}".format(self.id)
+
+
+def test_flush():
+    db = Database()
+    store = Store(db)
+
+    model = Model(1)
+    model.dirty[u"nick"] = u"foo"
+    store.save(model)
+    model.dirty[u"nick"] = u"bar"
+    store.save(model)
+
+    store.flush()
+    store.flush()
+
+    assert db.executed == [[(u"hmset", u"test:1", {u"nick": u"bar"})]]
+    assert not model.dirty
+
+
+def test_writebehind():
+    db = Database()
+    store = Store(db)
+    store.start()
+
+    model = Model(1)
+    model.dirty[u"nick"] = u"foo"
+    store.save(model)
+    store.flush()
+
+    store.delete(model)
+    store.stop()
+
+    assert store.writer.batches == 2
+    assert store.writer.commands == 2
+    assert db.executed == [
+        [(u"hmset", u"test:1", {u"nick": u"foo"})],
+        [(u"delete", u"test:1")],
+    ]
+
+
+def test_claim():
+    redis = pytest.importorskip("redis")
+
+    db = redis.StrictRedis()
+    try:
+        db.ping()
+    except redis.ConnectionError:
+        pytest.skip("Redis is not running")
+
+    store = Store(db)
+    db.delete(store.key(u"nicks"))
+
+    foo, bar = Model(1), Model(2)
+
+    # foo -> bar -> foo within one tick keeps the claim on foo
+    assert store.claim(u"foo", foo)
+    assert store.claim(u"bar", foo)
+    store.release(u"foo", foo)
+    assert store.claim(u"foo", foo)
+    store.release(u"bar", foo)
+    store.flush()
+
+    assert not store.claim(u"foo", bar)
+    assert store.claim(u"bar", bar)
+
+    # Only the holder can release a claim
+    store.release(u"bar", foo)
+    assert not store.claim(u"bar", foo)
+
+    db.delete(store.key(u"nicks"))
+
+
+def test_deferred():
+    db = Database()
+    store = Store(db)
+
+    # Write-behind without a writer, its queue already full
+    store.queue, store.maxdeferred = Queue(1), 2
+    store.queue.put(Pipeline(db))
+
+    for id in (1, 2):
+        model = Model(id)
+        model.dirty[u"nick"] = u"foo"
+        store.save(model)
+
+        if id == 2:
+            # Stands in for the writer catching up
+            Timer(0.1, store.queue.get).start()
+
+        store.flush()
+
+    # Merged into one pipeline until it reached maxdeferred commands
+    assert store.pipe is None
+    assert len(store.queue.get_nowait().command_stack) == 2
+
+
+def test_found():
+    redis = pytest.importorskip("redis")
+
+    db = redis.StrictRedis()
+    try:
+        db.ping()
+    except redis.ConnectionError:
+        pytest.skip("Redis is not running")
+
+    store = Store(db)
+    db.delete(store.key(u"founders"))
+
+    # The same channel as two workers see it
+    first, second = Channel(u"#test"), Channel(u"#Test")
+    alice, bob = Model(1), Model(2)
+
+    assert store.found(first, alice)
+    assert not store.found(second, bob)
+    assert store.founder(second) == alice.id
+
+    # Emptied and created again by bob before the first worker saw it
+    # empty, which must not release bob's founding
+    db.hset(store.key(u"founders"), u"#test", bob.id)
+    store.disband(first)
+    assert store.founder(second) == bob.id
+
+    store.disband(second)
+    assert store.founder(first) == 0
+
+    db.delete(store.key(u"founders"))
@@ -0,0 +1,23 @@
+"""Test Utils"""
+
+
+from charla.utils import casefold, compile_mask
+
+
+def test_casefold():
+    assert casefold(u"FooBar") == u"foobar"
+    assert casefold(u"[Foo]\\Bar~") == u"{foo}|bar^"
+    assert casefold(u"#Circuits") == casefold(u"#circuits")
+
+
+def test_compile_mask():
+    mask = compile_mask(u"#Foo*")
+
+    assert mask.match(casefold(u"#foobar"))
+    assert mask.match(casefold(u"#FOO"))
+    assert not mask.match(casefold(u"#bar"))
+
+    mask = compile_mask(u"#[a]?")
+
+    assert mask.match(casefold(u"#[A]b"))
+    assert not mask.match(casefold(u"#ab"))
@@ -0,0 +1,78 @@
+"""Test Wheel"""
+
+
+from charla.wheel import Wheel
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_schedule():
+    clock = Clock()
+    wheel = Wheel(slots=4, levels=3, clock=clock)
+
+    fired = []
+    for delay in (1, 3, 5, 17, 70, 200):
+        wheel.schedule(delay, fired.append, delay)
+
+    assert len(wheel) == 6
+
+    for now in range(1, 201):
+        clock.now = now
+        wheel.advance()
+        assert fired == [delay for delay in (1, 3, 5, 17, 70, 200) if delay <= now]
+
+    assert len(wheel) == 0
+
+
+def test_cancel():
+    clock = Clock()
+    wheel = Wheel(slots=4, levels=2, clock=clock)
+
+    fired = []
+    timer = wheel.schedule(10, fired.append, 10)
+    wheel.schedule(5, timer.cancel)
+    wheel.schedule(2, fired.append, 2).cancel()
+
+    clock.now = 10
+    wheel.advance()
+
+    assert fired == []
+    assert not timer.pending
+    assert len(wheel) == 0
+
+
+def test_partial_tick():
+    clock = Clock()
+    clock.now = 0.5
+    wheel = Wheel(clock=clock)
+
+    fired = []
+    wheel.schedule(1, fired.append, 1)
+
+    clock.now = 1.4
+    assert wheel.advance() == 0
+
+    clock.now = 2
+    assert wheel.advance() == 1
+    assert fired == [1]
+
+
+def test_timeout():
+    clock = Clock()
+    wheel = Wheel(resolution=0.5, clock=clock)
+
+    assert wheel.timeout() == 0.5
+
+    clock.now = 0.25
+    assert wheel.timeout() == 0.25
+
+    clock.now = 1.25
+    wheel.advance()
+    assert wheel.timeout() == 0.25